@@ -1,10 +1,49 @@
+import json
+import asyncio
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from rag.pipeline import rag_pipeline
+from fastapi.responses import StreamingResponse, JSONResponse
+from typing import List
+from pydantic import BaseModel, Field
+from rag.pipeline import rag_pipeline_async, rag_pipeline_stream, rag_pipeline_batch, answer_cache
+from rag.retriever import query_cache, batcher, search_executor, warmup, is_ready
+from rag import generator, chunker
 import uvicorn
 
-app = FastAPI(title="LNMIIT Chatbot API")
+async def warm_up_retriever():
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    # Heavy imports (torch, grpc) happen here rather than at module import time
+    try:
+        await loop.run_in_executor(None, generator.get_model)
+    except Exception as e:
+        print(f"Gemini client init failed: {e}")
+    # Prompt token counting loads the embedding tokenizer on first use
+    try:
+        await loop.run_in_executor(None, chunker.tokenizer_name)
+    except Exception as e:
+        print(f"Tokenizer load failed: {e}")
+    try:
+        ok = await loop.run_in_executor(search_executor, warmup)
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+        return
+    if ok:
+        print(f"Retriever warm in {time.perf_counter() - start:.2f}s")
+    else:
+        print("Warm-up incomplete: collection not found. /ready turns ready once the index is built.")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warm up in the background: "/" answers immediately, "/ready" flips once hot.
+    task = asyncio.create_task(warm_up_retriever())
+    yield
+    task.cancel()
+    search_executor.shutdown(wait=False)
+
+app = FastAPI(title="LNMIIT Chatbot API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,22 +56,83 @@ app.add_middleware(
 class ChatRequest(BaseModel):
     query: str
 
+MAX_BATCH_QUERIES = 1000
+
+class BatchChatRequest(BaseModel):
+    queries: List[str] = Field(..., max_length=MAX_BATCH_QUERIES)
+    top_k: int = Field(5, ge=1, le=20)
+
 @app.get("/")
 def read_root():
     return {"status": "API is running"}
 
+@app.get("/ready")
+def ready_endpoint():
+    if not is_ready():
+        return JSONResponse(status_code=503, content={"status": "warming up"})
+    return {"status": "ready"}
+
+@app.get("/stats")
+def stats_endpoint():
+    return {
+        "answer_cache": answer_cache.stats(),
+        "query_embedding_cache": query_cache.stats(),
+        "query_batcher": batcher.stats(),
+        "prompts": generator.prompt_stats.stats(),
+        "retrieval_gate": generator.gate_stats.stats(),
+    }
+
 @app.post("/chat")
-def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest):
     """
     Endpoint to chat with the RAG model.
+    Retrieval runs on the bounded search pool and the Gemini call is awaited,
+    so slow LLM round-trips do not tie up worker threads.
     """
     try:
-        result = rag_pipeline(request.query)
+        result = await rag_pipeline_async(request.query)
         return result
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: BatchChatRequest):
+    """
+    Answer a list of queries in one call (FAQ generation, evaluation runs).
+    Results come back in input order; failures are reported per item.
+    More than MAX_BATCH_QUERIES queries or a top_k outside 1-20 is rejected with 422.
+    """
+    try:
+        results = await rag_pipeline_batch(request.queries, top_k=request.top_k)
+        return {"results": results}
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Server-Sent Events version of /chat: a `sources` event right after
+    retrieval, then `token` events as the answer is generated, then `done`.
+    """
+    async def events():
+        try:
+            async for event, data in rag_pipeline_stream(request.query):
+                yield sse_event(event, data)
+        except Exception as e:
+            print(f"Error: {e}")
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 if __name__ == "__main__":
     # Run the server on port 8000
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
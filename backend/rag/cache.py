@@ -0,0 +1,273 @@
+# cache.py  (in-process caches for the RAG pipeline: answers and query embeddings)
+
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent          # backend/
+# Written by indexer.build_index every time a new index is produced
+INDEX_VERSION_PATH = BASE_DIR / "data" / "indexed_data" / "index_version.json"
+
+ANSWER_CACHE_SIZE = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "2048"))
+ANSWER_CACHE_TTL = float(os.environ.get("RAG_ANSWER_CACHE_TTL", str(24 * 3600)))
+# Cosine similarity above which two phrasings count as the same question
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("RAG_ANSWER_CACHE_THRESHOLD", "0.92"))
+
+# Query embedding cache (retriever.embed_query)
+QUERY_CACHE_BYTES = int(os.environ.get("RAG_QUERY_CACHE_BYTES", str(16 * 1024 * 1024)))
+QUERY_CACHE_DTYPE = os.environ.get("RAG_QUERY_CACHE_DTYPE", "float16")
+# Optional .npz file the cache is loaded from and saved to, so it survives restarts
+QUERY_CACHE_PATH = os.environ.get("RAG_QUERY_CACHE_PATH", "")
+
+
+def normalize_query(query: str) -> str:
+    q = query.lower()
+    q = re.sub(r"[^\w\s]", " ", q)
+    return re.sub(r"\s+", " ", q).strip()
+
+
+_version_lock = threading.Lock()
+_version_state = {"mtime": None, "version": None}
+
+def read_index_version():
+    """Current index version, re-read only when the version file changes."""
+    try:
+        mtime = INDEX_VERSION_PATH.stat().st_mtime_ns
+    except OSError:
+        return None
+    with _version_lock:
+        if mtime != _version_state["mtime"]:
+            try:
+                with open(INDEX_VERSION_PATH, "r", encoding="utf-8") as f:
+                    _version_state["version"] = json.load(f).get("version")
+                _version_state["mtime"] = mtime
+            except (OSError, ValueError):
+                # Half-written by the indexer; try again on the next call
+                return _version_state["version"]
+        return _version_state["version"]
+
+
+class AnswerCache:
+    """
+    Exact-match map on the normalised query, backed by a nearest-neighbour
+    lookup over the embeddings of past queries. Entries expire after `ttl`
+    seconds, the least recently used ones are evicted past `max_entries`,
+    and everything is dropped when the index version changes.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()   # key -> (answer, sources, embedding, created_at)
+        self._lock = threading.Lock()
+        self._matrix = None             # stacked embeddings, rebuilt lazily
+        self._matrix_keys = []
+        self._version = read_index_version()
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @property
+    def semantic(self):
+        return self.enabled and self.threshold < 1.0
+
+    def _check_version(self):
+        version = read_index_version()
+        if version != self._version:
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+            self.invalidations += 1
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[3] > self.ttl:
+            del self._entries[key]
+            self._matrix = None
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get_exact(self, query):
+        """(answer, sources) for an identical normalised query, else None. Misses are not counted."""
+        if not self.enabled:
+            return None
+        key = normalize_query(query)
+        with self._lock:
+            self._check_version()
+            entry = self._fresh(key)
+            if entry is None:
+                return None
+            self.hits_exact += 1
+            return entry[0], entry[1]
+
+    def get(self, query, embedding=None):
+        """Exact lookup, then nearest-neighbour lookup when `embedding` is given."""
+        if not self.enabled:
+            return None
+        key = normalize_query(query)
+        with self._lock:
+            self._check_version()
+            entry = self._fresh(key)
+            if entry is not None:
+                self.hits_exact += 1
+                return entry[0], entry[1]
+
+            if embedding is not None and self.semantic:
+                if self._matrix is None:
+                    self._matrix_keys = [k for k, e in self._entries.items() if e[2] is not None]
+                    self._matrix = np.vstack([self._entries[k][2] for k in self._matrix_keys]) if self._matrix_keys else None
+            if embedding is not None and self._matrix is not None:
+                scores = self._matrix @ np.asarray(embedding, dtype=np.float32)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = self._fresh(self._matrix_keys[best])
+                    if entry is not None:
+                        self.hits_semantic += 1
+                        return entry[0], entry[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, query, answer, sources, embedding=None):
+        if not self.enabled:
+            return
+        key = normalize_query(query)
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        with self._lock:
+            self._check_version()
+            self._entries[key] = (answer, sources, embedding, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits_exact + self.hits_semantic + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits_exact": self.hits_exact,
+                "hits_semantic": self.hits_semantic,
+                "misses": self.misses,
+                "hit_rate": round((self.hits_exact + self.hits_semantic) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "index_version": self._version,
+            }
+
+
+class EmbeddingCache:
+    """
+    LRU of normalised-query -> embedding, bounded by a byte budget rather than
+    an entry count. Vectors are stored compactly (float16 by default) and
+    handed back as float32.
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_BYTES, dtype=QUERY_CACHE_DTYPE, model_name=""):
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.model_name = model_name
+        self._entries = OrderedDict()   # key -> compact vector
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _cost(key, vec):
+        return vec.nbytes + len(key)
+
+    def get(self, query):
+        key = normalize_query(query)
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec.astype(np.float32)
+
+    def put(self, query, embedding):
+        if self.max_bytes <= 0:
+            return
+        key = normalize_query(query)
+        self._put(key, np.asarray(embedding).ravel().astype(self.dtype))
+
+    def _put(self, key, vec):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= self._cost(key, old)
+            self._entries[key] = vec
+            self.nbytes += self._cost(key, vec)
+            while self.nbytes > self.max_bytes and self._entries:
+                k, v = self._entries.popitem(last=False)
+                self.nbytes -= self._cost(k, v)
+                self.evictions += 1
+
+    def save(self, path):
+        """Write the cache to an .npz file (least recently used first)."""
+        with self._lock:
+            keys = list(self._entries.keys())
+            if not keys:
+                return
+            matrix = np.vstack(list(self._entries.values()))
+        # Per-process name: every uvicorn worker saves from atexit at shutdown
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys), vectors=matrix, model=np.array(self.model_name))
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Load entries saved by `save`; ignored if missing or from another model."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data["model"]) != self.model_name:
+                    print(f"Ignoring query cache {path}: built for model {data['model']}")
+                    return 0
+                keys = data["keys"].tolist()
+                vectors = data["vectors"].astype(self.dtype)
+        except Exception as e:
+            print(f"Could not load query cache {path}: {e}")
+            return 0
+        for key, vec in zip(keys, vectors):
+            self._put(key, vec)
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
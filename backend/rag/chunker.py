@@ -0,0 +1,230 @@
+# chunker.py  (token-aware chunking shared by scraper and processor)
+
+import os
+import re
+import math
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent          # backend/
+EMBED_MODEL = "all-MiniLM-L6-v2"
+# The encoder truncates at max_seq_length (256 for all-MiniLM-L6-v2), which
+# includes [CLS] and [SEP]; anything past it is never embedded.
+MAX_SEQ_TOKENS = int(os.environ.get("RAG_MAX_SEQ_TOKENS", "256"))
+CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", str(MAX_SEQ_TOKENS - 2)))
+MIN_CHUNK_TOKENS = int(os.environ.get("RAG_MIN_CHUNK_TOKENS", "48"))
+
+_SENTENCE_END = re.compile(r"(?<=[.?!])\s+")
+_BLANK_LINE = re.compile(r"\n\s*\n")
+_PIECE = re.compile(r"\w+|[^\w\s]")
+_HEADING_MAX_WORDS = 10
+
+_tokenizer = None
+_tokenizer_name = None
+
+
+def _load_tokenizer(model_name=EMBED_MODEL):
+    """
+    The embedding model's tokenizer, from local files only (chunking runs in
+    every processor worker and must not wait on the network): the copy saved
+    by `encoder.py export`, else the Hugging Face cache the encoder filled.
+    Returns (encode, name); encode is None when no tokenizer is found.
+    """
+    repo = f"sentence-transformers/{model_name}"
+    try:
+        from tokenizers import Tokenizer
+        path = BASE_DIR / "data" / "onnx" / model_name.replace("/", "_") / "tokenizer.json"
+        if not path.exists():
+            from huggingface_hub import try_to_load_from_cache
+            path = try_to_load_from_cache(repo, "tokenizer.json")
+        if isinstance(path, (str, Path)) and os.path.exists(path):
+            tok = Tokenizer.from_file(str(path))
+            tok.no_truncation()
+            tok.no_padding()
+            return (lambda texts: [len(e.ids) for e in tok.encode_batch(texts, add_special_tokens=False)]), model_name
+    except Exception:
+        pass
+    try:
+        from transformers import AutoTokenizer
+        tok = AutoTokenizer.from_pretrained(repo, local_files_only=True)
+        return (lambda texts: [len(ids) for ids in tok(texts, add_special_tokens=False)["input_ids"]]), model_name
+    except Exception:
+        return None, "approx"
+
+
+def _approx_count(text):
+    """
+    WordPiece-like estimate without a tokenizer: short words are one token,
+    longer ones a piece per ~4 extra characters, punctuation one each.
+    Errs on the high side so estimated chunks still fit the model.
+    """
+    n = 0
+    for piece in _PIECE.findall(text):
+        n += 1 if len(piece) <= 6 else 1 + math.ceil((len(piece) - 6) / 4)
+    return n
+
+
+def _counter():
+    global _tokenizer, _tokenizer_name
+    if _tokenizer_name is None:
+        _tokenizer, _tokenizer_name = _load_tokenizer()
+        if _tokenizer is None:
+            print("Chunker: embedding tokenizer not available, approximating token counts")
+    return _tokenizer
+
+
+def tokenizer_name():
+    """Which token counter is in use (the model name, or "approx")."""
+    _counter()
+    return _tokenizer_name
+
+
+def count_tokens_batch(texts):
+    encode = _counter()
+    if not texts:
+        return []
+    return encode(texts) if encode else [_approx_count(t) for t in texts]
+
+
+def count_tokens(text):
+    return count_tokens_batch([text])[0]
+
+
+def _is_heading(line, prev_line):
+    if line.startswith("#"):
+        return True
+    if len(line.split()) > _HEADING_MAX_WORDS or line[-1] in ".!?;:,":
+        return False
+    # Otherwise short lines only start a section after a finished sentence,
+    # so hard-wrapped PDF lines are joined back into their paragraph
+    return prev_line is None or prev_line[-1] in ".!?:"
+
+
+def _blocks(text):
+    """Yield (is_heading, paragraph) from blank-line / line structure of the text."""
+    for block in _BLANK_LINE.split(text):
+        prev, para = None, []
+        for line in block.split("\n"):
+            line = " ".join(line.split())
+            if not line:
+                continue
+            if _is_heading(line, prev):
+                if para:
+                    yield False, " ".join(para)
+                    para = []
+                yield True, line.lstrip("#").strip() or line
+            else:
+                para.append(line)
+            prev = line
+        if para:
+            yield False, " ".join(para)
+
+
+def _split_word(word, max_tokens, n):
+    """
+    Cut a single over-long word (a URL, a base64 blob, a run of text without
+    spaces) into character slices of at most max_tokens tokens each.
+    """
+    size = max(1, len(word) * max_tokens // n * 9 // 10)
+    slices = [word[i:i + size] for i in range(0, len(word), size)]
+    pieces = []
+    for piece, pn in zip(slices, count_tokens_batch(slices)):
+        if pn > max_tokens and len(piece) > 1:
+            pieces.extend(_split_word(piece, max_tokens, pn))
+        else:
+            pieces.append((piece, pn))
+    return pieces
+
+
+def _split_long(sentence, max_tokens, first=None):
+    """
+    Cut a sentence longer than max_tokens into word runs that fit; the first
+    run fills the `first` tokens left in the chunk being built. A word that
+    does not fit on its own is cut into character slices.
+    """
+    words = []
+    for word, n in zip(sentence.split(), count_tokens_batch(sentence.split())):
+        words.extend(_split_word(word, max_tokens, n) if n > max_tokens else [(word, n)])
+    pieces, cur, cur_n = [], [], 0
+    budget = max_tokens if first is None else first
+    for word, n in words:
+        if cur_n + n > budget and (cur or budget < max_tokens):
+            if cur:
+                pieces.append((" ".join(cur), cur_n))
+            cur, cur_n, budget = [], 0, max_tokens
+        cur.append(word)
+        cur_n += n
+    if cur:
+        pieces.append((" ".join(cur), cur_n))
+    return pieces
+
+
+def split_chunks(text, max_tokens=CHUNK_TOKENS, min_tokens=MIN_CHUNK_TOKENS):
+    """
+    Chunks of at most `max_tokens` embedding tokens as (text, token count).
+    WordPiece splits on whitespace first, so the count of a chunk is the sum
+    of the counts of its sentences.
+    Sentences are packed whole, a heading starts a new chunk (unless the
+    current one is still under `min_tokens`), and only a sentence longer than
+    `max_tokens` on its own is cut, at word boundaries (and a single
+    word longer than that, by characters). A short last chunk is
+    merged into the previous one when it fits. Chunks do not overlap.
+    """
+    if not text or not text.strip():
+        return []
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    units = []          # (is_heading, sentence, is_paragraph_start)
+    for heading, para in _blocks(text):
+        if heading:
+            units.append((True, para, True))
+        else:
+            for i, s in enumerate(_SENTENCE_END.split(para)):
+                if s.strip():
+                    units.append((False, s.strip(), i == 0))
+    counts = count_tokens_batch([u[1] for u in units])
+
+    chunks = []
+    cur, cur_n = "", 0
+
+    def flush():
+        nonlocal cur, cur_n
+        if cur:
+            chunks.append((cur, cur_n))
+        cur, cur_n = "", 0
+
+    for (heading, unit, para_start), n in zip(units, counts):
+        if heading and cur_n >= min_tokens:
+            flush()
+        pieces = _split_long(unit, max_tokens, max_tokens - cur_n) if n > max_tokens else [(unit, n)]
+        for piece, pn in pieces:
+            if cur and cur_n + pn > max_tokens:
+                flush()
+            if cur:
+                cur += ("\n" if heading or para_start else " ") + piece
+                cur_n += pn
+            else:
+                cur, cur_n = piece, pn
+    flush()
+
+    if len(chunks) > 1 and chunks[-1][1] < min_tokens and chunks[-2][1] + chunks[-1][1] <= max_tokens:
+        (prev, pn), (last, ln) = chunks[-2], chunks[-1]
+        chunks[-2:] = [(prev + "\n" + last, pn + ln)]
+    return chunks
+
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS, min_tokens=MIN_CHUNK_TOKENS):
+    return [c for c, _ in split_chunks(text, max_tokens, min_tokens)]
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Chunk a text file and show chunk token counts")
+    parser.add_argument("path", nargs="?", help="Text file (default: stdin)")
+    parser.add_argument("--max-tokens", type=int, default=CHUNK_TOKENS)
+    args = parser.parse_args()
+    text = open(args.path, encoding="utf-8").read() if args.path else sys.stdin.read()
+    chunks = split_chunks(text, args.max_tokens)
+    print(f"{len(chunks)} chunks, tokenizer: {tokenizer_name()}")
+    for i, (chunk, n) in enumerate(chunks):
+        print(f"--- {i}: {n} tokens ---\n{chunk}")
@@ -0,0 +1,284 @@
+# crawl_state.py  (persistent crawl frontier + visited/failed sets for scraper.crawl)
+
+import os
+import json
+import time
+import sqlite3
+import logging
+from datetime import datetime
+
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+STATE_PATH = os.path.join(OUTPUT_DIR, "crawl_state.sqlite3")
+# New / changed / removed URLs since the processor last ran (see update_manifest).
+# Informational: the processor only summarises it, nothing downstream reads it.
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, "crawl_manifest.json")
+
+COMMIT_EVERY = 200          # writes per transaction
+COMMIT_INTERVAL = 5.0       # ... or seconds, whichever comes first
+
+# status values: a URL is inserted once and then only changes status
+QUEUED, IN_FLIGHT, DONE, FAILED, BLOCKED, GONE = "queued", "in_flight", "done", "failed", "blocked", "gone"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    key        TEXT NOT NULL UNIQUE,       -- normalize_url_for_dedupe(url)
+    url        TEXT NOT NULL,              -- URL as discovered, used for fetching
+    depth      INTEGER NOT NULL,
+    priority   INTEGER NOT NULL DEFAULT 0, -- higher is fetched first
+    status     TEXT NOT NULL,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    error      TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_frontier ON urls (status, priority DESC, depth, seq);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+# Per-URL results of the last successful fetch, used for conditional re-crawls.
+# Added with ALTER TABLE so databases from before re-crawl support still open.
+FETCH_COLUMNS = {
+    "etag": "TEXT",
+    "last_modified": "TEXT",
+    "content_hash": "TEXT",
+    "out_file": "TEXT",                     # raw JSONL written for this URL, if any
+    "generation": "INTEGER NOT NULL DEFAULT 0",  # last crawl generation that confirmed the URL
+}
+
+
+class CrawlState:
+    """
+    Crawl frontier, visited and failed URLs in one SQLite table (WAL mode).
+    Enqueueing is INSERT OR IGNORE on the normalised URL, so a URL is queued at
+    most once per crawl no matter how many pages link to it. Writes are
+    committed in batches; after a crash, URLs that were in flight are queued
+    again on open, so the crawl resumes where it stopped.
+    Use from one thread only (the crawl coordinator).
+    """
+
+    def __init__(self, path=STATE_PATH, commit_every=COMMIT_EVERY, commit_interval=COMMIT_INTERVAL):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(urls)")}
+        for name, decl in FETCH_COLUMNS.items():
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE urls ADD COLUMN {name} {decl}")
+        self._writes = 0
+        self._last_commit = time.monotonic()
+        recovered = self.conn.execute("UPDATE urls SET status = ? WHERE status = ?", (QUEUED, IN_FLIGHT)).rowcount
+        self.conn.commit()
+        if recovered:
+            logging.info(f"[state] Re-queued {recovered} URLs that were in flight when the last crawl stopped")
+
+    def _wrote(self, n=1):
+        self._writes += n
+        if self._writes >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._writes = 0
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def reset(self):
+        """Forget everything (a fresh, non-resumed crawl)."""
+        self.conn.execute("DELETE FROM urls")
+        self.commit()
+
+    @property
+    def generation(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def begin_refresh(self, max_depth=None):
+        """
+        Start a re-crawl of everything known: done and failed URLs up to
+        `max_depth` are queued again (keeping their validators) under a new
+        generation. Deeper URLs are out of reach of this crawl, so they keep
+        their output and are carried into the new generation as they are.
+        If a previous refresh is still unfinished, it is resumed instead.
+        """
+        depth_sql, depth_args = ("", ()) if max_depth is None else (" AND depth <= ?", (max_depth,))
+        if self.conn.execute(f"SELECT 1 FROM urls WHERE status = ?{depth_sql} LIMIT 1",
+                             (QUEUED, *depth_args)).fetchone():
+            logging.info(f"[state] Resuming unfinished crawl generation {self.generation}")
+            return self.generation
+        generation = self.generation + 1
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (str(generation),))
+        n = self.conn.execute(f"UPDATE urls SET status = ?, attempts = 0 WHERE status IN (?, ?){depth_sql}",
+                              (QUEUED, DONE, FAILED, *depth_args)).rowcount
+        if max_depth is not None:
+            self.conn.execute("UPDATE urls SET generation = ? WHERE depth > ?", (generation, max_depth))
+        self.commit()
+        logging.info(f"[state] Refresh generation {generation}: {n} URLs queued")
+        return generation
+
+    def validators(self, key):
+        """(etag, last_modified, content_hash, out_file) from the last successful fetch."""
+        row = self.conn.execute("SELECT etag, last_modified, content_hash, out_file FROM urls WHERE key = ?",
+                                (key,)).fetchone()
+        return row or (None, None, None, None)
+
+    def record_fetch(self, key, etag=None, last_modified=None, content_hash=None, out_file=None, keep=False):
+        """
+        Mark a URL DONE and confirmed in this generation. With `keep` (a 304 or
+        an unchanged body) the stored content hash and output file stay as they are.
+        """
+        if keep:
+            self.conn.execute(
+                "UPDATE urls SET status = ?, attempts = attempts + 1, error = NULL, updated_at = ?, generation = ?, "
+                "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE key = ?",
+                (DONE, time.time(), self.generation, etag, last_modified, key))
+        else:
+            self.conn.execute(
+                "UPDATE urls SET status = ?, attempts = attempts + 1, error = NULL, updated_at = ?, generation = ?, "
+                "etag = ?, last_modified = ?, content_hash = ?, out_file = ? WHERE key = ?",
+                (DONE, time.time(), self.generation, etag, last_modified, content_hash, out_file, key))
+        self._wrote()
+
+    def stale_outputs(self):
+        """(key, url, out_file) of URLs with output that this generation has not confirmed."""
+        return self.conn.execute(
+            "SELECT key, url, out_file FROM urls WHERE out_file IS NOT NULL AND generation < ? AND status != ?",
+            (self.generation, FAILED)).fetchall()
+
+    def has_queued(self):
+        """True while any URL, at any depth, is still waiting to be fetched."""
+        return self.conn.execute("SELECT 1 FROM urls WHERE status = ? LIMIT 1", (QUEUED,)).fetchone() is not None
+
+    def drop_output(self, key):
+        self.conn.execute("UPDATE urls SET out_file = NULL, content_hash = NULL WHERE key = ?", (key,))
+        self._wrote()
+
+    def enqueue_many(self, entries):
+        """entries: iterable of (key, url, depth, priority). Returns how many were new."""
+        now = time.time()
+        rows = [(key, url, depth, priority, QUEUED, now) for key, url, depth, priority in entries]
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO urls (key, url, depth, priority, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            rows)
+        added = self.conn.total_changes - before
+        self._wrote(added)
+        return added
+
+    def enqueue(self, key, url, depth, priority=0):
+        return self.enqueue_many([(key, url, depth, priority)]) == 1
+
+    def pop(self, n, max_depth=None):
+        """Take up to `n` queued URLs (highest priority, then shallowest first) and mark them in flight."""
+        sql = "SELECT seq, key, url, depth FROM urls WHERE status = ?"
+        args = [QUEUED]
+        if max_depth is not None:
+            sql += " AND depth <= ?"
+            args.append(max_depth)
+        sql += " ORDER BY priority DESC, depth, seq LIMIT ?"
+        args.append(n)
+        rows = self.conn.execute(sql, args).fetchall()
+        if rows:
+            self.conn.executemany("UPDATE urls SET status = ? WHERE seq = ?", [(IN_FLIGHT, r[0]) for r in rows])
+            self._wrote(len(rows))
+        return [(key, url, depth) for _, key, url, depth in rows]
+
+    def mark(self, key, status, error=None):
+        """Record the outcome for a popped URL: DONE, FAILED, BLOCKED, or QUEUED to hand it back."""
+        attempts = 1 if status in (DONE, FAILED) else 0
+        self.conn.execute("UPDATE urls SET status = ?, error = ?, attempts = attempts + ?, updated_at = ? WHERE key = ?",
+                          (status, error, attempts, time.time(), key))
+        if status == FAILED:
+            # A transient failure does not mean the page is gone: keep its output
+            self.conn.execute("UPDATE urls SET generation = ? WHERE key = ?", (self.generation, key))
+        self._wrote()
+
+    def retry_failed(self, max_attempts=3):
+        """Queue failed URLs again unless they already failed `max_attempts` times."""
+        n = self.conn.execute("UPDATE urls SET status = ? WHERE status = ? AND attempts < ?",
+                              (QUEUED, FAILED, max_attempts)).rowcount
+        self.commit()
+        return n
+
+    def counts(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM urls GROUP BY status").fetchall())
+
+    def import_visited_json(self, path):
+        """
+        One-off migration from the old visited.json: its URLs become DONE and
+        the file is renamed to *.migrated so it is not imported twice.
+        """
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                visited = json.load(fh).get("visited", [])
+        except Exception as e:
+            logging.warning(f"[state] Could not read {path}: {e}")
+            return 0
+        now = time.time()
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO urls (key, url, depth, priority, status, updated_at) VALUES (?, ?, 0, 0, ?, ?)",
+            [(key, key, DONE, now) for key in visited])
+        added = self.conn.total_changes - before
+        self.commit()
+        os.replace(path, path + ".migrated")
+        logging.info(f"[state] Imported {added} visited URLs from {path}")
+        return added
+
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """{url: {"status": "new"|"changed"|"removed", "file": raw file name}} or {} if there is none."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as fh:
+        return json.load(fh).get("changes", {})
+
+
+def update_manifest(events, path=MANIFEST_PATH):
+    """
+    Merge (url, status, file) events into the pending manifest, so several crawls
+    between two processor runs still add up to one net change per URL
+    (e.g. new then removed cancels out, removed then new is a change).
+    """
+    changes = load_manifest(path)
+    for url, status, fname in events:
+        prev = changes.get(url, {}).get("status")
+        if prev == "new" and status == "removed":
+            changes.pop(url)
+            continue
+        if prev == "new":
+            status = "new"
+        elif prev == "removed" and status == "new":
+            status = "changed"
+        changes[url] = {"status": status, "file": fname}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump({"updated_at": datetime.utcnow().isoformat(), "changes": changes}, fh, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return changes
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect the crawl state database")
+    parser.add_argument("--path", default=STATE_PATH)
+    parser.add_argument("--failed", action="store_true", help="List failed URLs with their last error")
+    args = parser.parse_args()
+
+    state = CrawlState(args.path)
+    print(json.dumps(state.counts(), indent=2))
+    if args.failed:
+        for url, attempts, error in state.conn.execute(
+                "SELECT url, attempts, error FROM urls WHERE status = ? ORDER BY updated_at", (FAILED,)):
+            print(f"{attempts}x {url}: {error}")
+    state.close()
@@ -0,0 +1,157 @@
+# dedupe.py  (corpus-wide near-duplicate detection: MinHash signatures + LSH banding)
+
+import os
+import re
+import json
+import zlib
+import numpy as np
+
+SHINGLE_SIZE = 5            # words per shingle
+LSH_BANDS = 20
+LSH_ROWS = 6                # BANDS x ROWS = signature length
+NUM_PERM = LSH_BANDS * LSH_ROWS
+# Estimated Jaccard similarity of the shingle sets above which two chunks are duplicates
+DEDUPE_THRESHOLD = float(os.environ.get("RAG_DEDUPE_THRESHOLD", "0.8"))
+
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD = re.compile(r"\w+")
+
+_rng = np.random.RandomState(1)
+# Fixed seed: signatures are cached on disk next to the shards and must stay comparable
+_PERM_A = _rng.randint(1, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, (1 << 61) - 1, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingle_hashes(text, k=SHINGLE_SIZE):
+    """32-bit hashes of the word k-grams of the lower-cased text."""
+    words = _WORD.findall(text.lower())
+    if not words:
+        return np.array([zlib.crc32(text.encode("utf-8"))], dtype=np.uint64)
+    k = min(k, len(words))
+    return np.unique(np.array([zlib.crc32(" ".join(words[i:i + k]).encode("utf-8"))
+                               for i in range(len(words) - k + 1)], dtype=np.uint64))
+
+
+def signature(text):
+    """MinHash signature (NUM_PERM uint32 values) of a chunk's shingle set."""
+    h = shingle_hashes(text)[:, None]
+    with np.errstate(over="ignore"):
+        perms = ((h * _PERM_A + _PERM_B) % _MERSENNE) & _MAX_HASH
+    return perms.min(axis=0).astype(np.uint32)
+
+
+def signatures(texts):
+    out = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    for i, text in enumerate(texts):
+        out[i] = signature(text)
+    return out
+
+
+def find_duplicates(sigs, threshold=DEDUPE_THRESHOLD):
+    """
+    Cluster near-duplicate rows of `sigs`. Rows sharing an LSH band bucket are
+    compared with the bucket's first row and merged (union-find) when the
+    fraction of equal MinHash values reaches `threshold`.
+    Returns a root index per row; rows with the same root are duplicates.
+    """
+    n = len(sigs)
+    parent = np.arange(n)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for band in range(LSH_BANDS):
+        cols = np.ascontiguousarray(sigs[:, band * LSH_ROWS:(band + 1) * LSH_ROWS])
+        keys = cols.view(np.dtype((np.void, cols.dtype.itemsize * LSH_ROWS))).ravel()
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], n]
+        for s, e in zip(starts, ends):
+            if e - s < 2:
+                continue
+            members = order[s:e]
+            head = members[0]
+            similar = members[1:][(sigs[members[1:]] == sigs[head]).mean(axis=1) >= threshold]
+            rh = find(head)
+            for m in similar:
+                rm = find(m)
+                if rm != rh:
+                    parent[rm] = rh
+    return np.array([find(i) for i in range(n)])
+
+
+def dedupe_corpus(shard_paths, out_path, threshold=DEDUPE_THRESHOLD):
+    """
+    Write the chunks of `shard_paths` (JSONL, each with a `<shard>.minhash.npz`
+    of signatures, content lengths and URLs) to `out_path`, keeping one chunk
+    per near-duplicate cluster: the longest, with the other members' URLs in
+    its "aliases". Returns (chunks in, chunks out, clusters with duplicates).
+    """
+    sigs, lengths, urls = [], [], []
+    for path in shard_paths:
+        with np.load(sig_path(path), allow_pickle=False) as data:
+            sigs.append(data["sig"])
+            lengths.append(data["length"])
+            urls.extend(data["url"].tolist())
+    total = sum(len(s) for s in sigs)
+    if total == 0:
+        open(out_path, "w").close()
+        return 0, 0, 0
+    sigs = np.vstack(sigs)
+    lengths = np.concatenate(lengths)
+
+    roots = find_duplicates(sigs, threshold)
+    keep = np.ones(total, dtype=bool)
+    aliases = {}
+    clusters = 0
+    order = np.lexsort((np.arange(total), -lengths, roots))     # by root, longest first
+    boundaries = np.flatnonzero(np.r_[True, roots[order][1:] != roots[order][:-1]])
+    for s, e in zip(boundaries, np.r_[boundaries[1:], total]):
+        if e - s < 2:
+            continue
+        clusters += 1
+        canonical, others = order[s], order[s + 1:e]
+        keep[others] = False
+        alias = sorted({urls[i] for i in others if urls[i] and urls[i] != urls[canonical]})
+        if alias:
+            aliases[canonical] = alias
+
+    tmp_path = out_path + ".tmp"
+    i = 0
+    with open(tmp_path, "w", encoding="utf-8") as out_f:
+        for path in shard_paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if keep[i]:
+                        if i in aliases:
+                            entry = json.loads(line)
+                            entry["aliases"] = aliases[i]
+                            line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+                        out_f.write(line)
+                    i += 1
+    os.replace(tmp_path, out_path)
+    return total, int(keep.sum()), clusters
+
+
+def sig_path(shard_path):
+    return str(shard_path)[:-len(".jsonl")] + ".minhash.npz"
+
+
+def save_signatures(shard_path, entries):
+    """Signatures of a shard's entries, row-aligned with its lines."""
+    path = sig_path(shard_path)
+    tmp_path = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path,
+             sig=signatures([e["content"] for e in entries]),
+             length=np.array([len(e["content"]) for e in entries], dtype=np.int64),
+             url=np.array([e.get("url") or "" for e in entries], dtype=str))
+    os.replace(tmp_path, path)
@@ -0,0 +1,101 @@
+# embedding_store.py  (content-addressed on-disk cache of chunk embeddings)
+
+import os, re, json, hashlib
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent          # backend/
+STORE_DIR = BASE_DIR / "data" / "embedding_cache"
+
+
+def text_hash(text: str) -> str:
+    """Embeddings depend only on the text, so that is all the key hashes."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def model_key(model_name: str, dim: int) -> str:
+    return f"{re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)}-{dim}"
+
+
+class EmbeddingStore:
+    """
+    Append-only float32 matrix (`vectors.f32`, read through np.memmap) plus a
+    text-hash -> row index (`index.json`), one directory per model key.
+    Switching the embedding model therefore never reuses stale vectors.
+    """
+
+    def __init__(self, model_name, dim, root=STORE_DIR):
+        self.dim = dim
+        self.dir = Path(root) / model_key(model_name, dim)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.dir / "vectors.f32"
+        self.index_path = self.dir / "index.json"
+        self.hits = 0
+        self.misses = 0
+
+        self.rows = self.vectors_path.stat().st_size // (4 * dim) if self.vectors_path.exists() else 0
+        if self.vectors_path.exists() and self.vectors_path.stat().st_size != self.rows * 4 * dim:
+            # A killed writer can leave a partial row; appending after it would
+            # shift every later row away from the offset its index entry points to
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(self.rows * 4 * dim)
+        self.index = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    # Rows past the end of the file were never fully written
+                    self.index = {h: r for h, r in json.load(f).items() if r < self.rows}
+            except (OSError, ValueError) as e:
+                print(f"Embedding cache index unreadable, starting empty: {e}")
+        self._mmap = None
+        self._writer = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _matrix(self):
+        if self._mmap is None or self._mmap.shape[0] != self.rows:
+            if self._writer is not None:
+                self._writer.flush()
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.rows, self.dim)) if self.rows else None
+        return self._mmap
+
+    def get_many(self, hashes):
+        """Returns (vectors, found) where vectors[i] is only valid if found[i]."""
+        out = np.zeros((len(hashes), self.dim), dtype=np.float32)
+        found = np.zeros(len(hashes), dtype=bool)
+        rows = [self.index.get(h) for h in hashes]
+        hit_idx = [i for i, r in enumerate(rows) if r is not None]
+        if hit_idx:
+            matrix = self._matrix()
+            out[hit_idx] = matrix[[rows[i] for i in hit_idx]]
+            found[hit_idx] = True
+        self.hits += len(hit_idx)
+        self.misses += len(hashes) - len(hit_idx)
+        return out, found
+
+    def add_many(self, hashes, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self._writer is None:
+            self._writer = open(self.vectors_path, "ab")
+        for h, vec in zip(hashes, vectors):
+            if h in self.index:
+                continue
+            self._writer.write(vec.tobytes())
+            self.index[h] = self.rows
+            self.rows += 1
+
+    def close(self):
+        """Flush vectors first, then the index, so the index never points past the data."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._mmap = None
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
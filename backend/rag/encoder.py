@@ -0,0 +1,315 @@
+# encoder.py  (sentence-embedding backends shared by the indexer and retriever)
+
+import os
+import sys
+import json
+import time
+import multiprocessing as mp
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent          # backend/
+EMBED_MODEL = "all-MiniLM-L6-v2"
+
+# torch: SentenceTransformer. onnx / onnx-int8: the same model exported by
+# `python rag/encoder.py export` and run with ONNX Runtime (no torch import).
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+ENCODER_BACKEND = os.environ.get("RAG_ENCODER_BACKEND", "torch")
+ONNX_DIR = BASE_DIR / "data" / "onnx"
+
+
+def encoder_key(model_name=EMBED_MODEL, backend=ENCODER_BACKEND):
+    """
+    Name embeddings are cached under. ONNX (and especially int8) vectors are
+    close to but not identical with torch ones, so each backend gets its own key.
+    """
+    return model_name if backend == "torch" else f"{model_name}-{backend}"
+
+
+def onnx_dir(model_name=EMBED_MODEL):
+    return ONNX_DIR / model_name.replace("/", "_")
+
+
+def pick_device():
+    import torch
+    if torch.cuda.is_available():
+        return "cuda"
+    if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def normalize(emb):
+    """Row-normalise so Inner Product == cosine."""
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    return (emb / (norms + 1e-10)).astype("float32")
+
+
+class LocalEncoder:
+    """One SentenceTransformer in this process."""
+
+    def __init__(self, model_name=EMBED_MODEL, device=None):
+        from sentence_transformers import SentenceTransformer
+        self.key = encoder_key(model_name, "torch")
+        self.device = device or pick_device()
+        self.model = SentenceTransformer(model_name, device=self.device)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+        return normalize(self.model.encode(list(texts), show_progress_bar=False, convert_to_numpy=True))
+
+    def encode_batches(self, batches):
+        for batch in batches:
+            yield self.encode(batch)
+
+    def close(self):
+        pass
+
+
+class OnnxEncoder:
+    """
+    The exported transformer on ONNX Runtime, with the tokenizer from the
+    `tokenizers` package and mean pooling + normalisation in NumPy, i.e. the
+    same steps as the SentenceTransformer pipeline without importing torch.
+    """
+
+    def __init__(self, model_name=EMBED_MODEL, quantized=False, threads=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        path = onnx_dir(model_name)
+        model_file = path / ("model.int8.onnx" if quantized else "model.onnx")
+        if not model_file.exists():
+            raise FileNotFoundError(f"{model_file} not found; run `python rag/encoder.py export` first")
+        with open(path / "config.json", "r", encoding="utf-8") as f:
+            config = json.load(f)
+
+        self.key = encoder_key(model_name, "onnx-int8" if quantized else "onnx")
+        self.device = "cpu"
+        self.dim = config["dim"]
+        self.tokenizer = Tokenizer.from_file(str(path / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=config["pad_id"], pad_token=config["pad_token"])
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(model_file), options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(texts)
+        mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feed = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": mask,
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: feed[name] for name in self.input_names})[0]
+        weights = mask[:, :, None].astype(np.float32)
+        pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        return normalize(pooled)
+
+    def encode_batches(self, batches):
+        for batch in batches:
+            yield self.encode(batch)
+
+    def close(self):
+        pass
+
+
+def export_onnx(model_name=EMBED_MODEL, quantize=True, opset=14):
+    """
+    One-off (needs torch): export the SentenceTransformer's transformer to
+    data/onnx/<model>/model.onnx, save its tokenizer and, with `quantize`,
+    write a dynamically int8-quantised model.int8.onnx next to it.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st = SentenceTransformer(model_name, device="cpu")
+    pooling = st[1].get_pooling_mode_str() if len(st) > 1 and hasattr(st[1], "get_pooling_mode_str") else None
+    if pooling != "mean":
+        raise ValueError(f"{model_name} uses {pooling!r} pooling; only mean pooling is implemented for ONNX")
+
+    path = onnx_dir(model_name)
+    path.mkdir(parents=True, exist_ok=True)
+    tokenizer = st.tokenizer
+    tokenizer.save_pretrained(str(path))
+
+    transformer = st[0].auto_model.eval()
+    sample = tokenizer(["LNMIIT export sample", "a second, longer sample sentence"], padding=True, return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    axes = {0: "batch", 1: "sequence"}
+    start = time.perf_counter()
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer, tuple(sample[n] for n in input_names), str(path / "model.onnx"),
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes={**{n: axes for n in input_names}, "last_hidden_state": axes},
+            opset_version=opset,
+        )
+    print(f"Exported {path / 'model.onnx'} in {time.perf_counter() - start:.1f}s")
+
+    config = {"model": model_name, "dim": st.get_sentence_embedding_dimension(),
+              "max_seq_length": st.max_seq_length, "pad_id": tokenizer.pad_token_id,
+              "pad_token": tokenizer.pad_token}
+    with open(path / "config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(str(path / "model.onnx"), str(path / "model.int8.onnx"), weight_type=QuantType.QInt8)
+        print(f"Quantized to {path / 'model.int8.onnx'}")
+    return path
+
+
+# --- process pool workers ---
+_worker_encoder = None
+
+def _init_worker(model_name, threads, backend):
+    global _worker_encoder
+    # One replica per process; pin its threads so N workers don't fight over the cores
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(threads)
+        _worker_encoder = LocalEncoder(model_name, device="cpu")
+    else:
+        _worker_encoder = OnnxEncoder(model_name, quantized=backend == "onnx-int8", threads=threads)
+
+def _worker_encode(texts):
+    return _worker_encoder.encode(texts)
+
+def _worker_dim(_=None):
+    return _worker_encoder.dim
+
+
+class ParallelEncoder:
+    """
+    Shards batches across a process pool on CPU, one model replica per worker
+    with its threads pinned to cores // workers. Results come back in order.
+    """
+
+    def __init__(self, model_name=EMBED_MODEL, workers=None, backend=ENCODER_BACKEND):
+        self.key = encoder_key(model_name, backend)
+        self.device = "cpu"
+        self.workers = workers or os.cpu_count() or 1
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        start = time.perf_counter()
+        # spawn: forking a process that already imported torch is not safe
+        self.pool = mp.get_context("spawn").Pool(self.workers, initializer=_init_worker,
+                                                 initargs=(model_name, threads, backend))
+        self.dim = self.pool.apply(_worker_dim)
+        print(f"Started {self.workers} {backend} embedding workers x {threads} threads in {time.perf_counter() - start:.1f}s")
+
+    def encode(self, texts):
+        return self.pool.apply(_worker_encode, (list(texts),))
+
+    def encode_batches(self, batches):
+        return self.pool.imap(_worker_encode, [list(b) for b in batches])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def get_encoder(model_name=EMBED_MODEL, workers=1, backend=ENCODER_BACKEND):
+    """Single in-process model, or a process pool when workers > 1 (CPU only)."""
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend!r}")
+    if workers and workers > 1:
+        return ParallelEncoder(model_name, workers, backend)
+    if backend == "torch":
+        return LocalEncoder(model_name)
+    return OnnxEncoder(model_name, quantized=backend == "onnx-int8")
+
+
+# --- parity / latency benchmark ---
+BENCH_TEXTS = [
+    "hostel facilities", "fee structure for btech", "who is the dean of academic affairs",
+    "placement statistics", "how do I apply for admission", "library timings",
+    "computer science faculty", "mess menu", "scholarships for students", "academic calendar",
+    "The LNM Institute of Information Technology is a deemed university located in Jaipur, Rajasthan.",
+    "Students must maintain at least 75 percent attendance in every course to be allowed to sit the end-semester examination.",
+]
+
+def _peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def _bench_one(backend, texts, repeats, out_path):
+    """Runs in a fresh interpreter so import cost and RSS belong to one backend."""
+    start = time.perf_counter()
+    # CPU for torch too: that is the deployment being compared
+    encoder = LocalEncoder(EMBED_MODEL, device="cpu") if backend == "torch" else get_encoder(EMBED_MODEL, backend=backend)
+    load_s = time.perf_counter() - start
+    np.save(out_path, encoder.encode(texts))
+    latencies = []
+    for i in range(repeats):
+        t = time.perf_counter()
+        encoder.encode([texts[i % len(texts)]])
+        latencies.append((time.perf_counter() - t) * 1000)
+    print(json.dumps({"backend": backend, "load_s": load_s, "rss_mb": _peak_rss_mb(),
+                      "p50_ms": float(np.percentile(latencies, 50)),
+                      "p95_ms": float(np.percentile(latencies, 95))}))
+
+def benchmark(backends=ENCODER_BACKENDS, texts=BENCH_TEXTS, repeats=200):
+    """Per-query CPU latency, peak RSS and cosine agreement with the torch embeddings."""
+    import subprocess, tempfile
+    rows, vectors = [], {}
+    with tempfile.TemporaryDirectory() as tmp:
+        texts_path = os.path.join(tmp, "texts.json")
+        with open(texts_path, "w", encoding="utf-8") as f:
+            json.dump(list(texts), f)
+        for backend in backends:
+            out_path = os.path.join(tmp, f"{backend}.npy")
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "_bench-one", backend,
+                                   texts_path, str(repeats), out_path], capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(f"{backend}: failed\n{proc.stderr.strip()[-2000:]}")
+                continue
+            rows.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+            vectors[backend] = np.load(out_path)
+
+    print(f"{'backend':<10} {'load s':>7} {'p50 ms':>8} {'p95 ms':>8} {'peak RSS MB':>12} {'cos mean':>9} {'cos min':>8}")
+    for row in rows:
+        cos_mean = cos_min = float("nan")
+        if "torch" in vectors:
+            cos = np.sum(vectors[row["backend"]] * vectors["torch"], axis=1)
+            cos_mean, cos_min = float(cos.mean()), float(cos.min())
+        print(f"{row['backend']:<10} {row['load_s']:>7.2f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+              f"{row['rss_mb']:>12.0f} {cos_mean:>9.4f} {cos_min:>8.4f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    if len(sys.argv) > 1 and sys.argv[1] == "_bench-one":
+        _, _, backend, texts_path, repeats, out_path = sys.argv
+        with open(texts_path, "r", encoding="utf-8") as f:
+            _bench_one(backend, json.load(f), int(repeats), out_path)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX and compare encoder backends")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="Write data/onnx/<model>/model.onnx (+ model.int8.onnx)")
+    export.add_argument("--no-quantize", action="store_true", help="Skip the int8 model")
+    bench = sub.add_parser("bench", help="Latency, peak RSS and cosine agreement with torch per backend")
+    bench.add_argument("--backends", nargs="+", choices=ENCODER_BACKENDS, default=list(ENCODER_BACKENDS))
+    bench.add_argument("--repeats", type=int, default=200, help="Single-query encodes timed per backend")
+    bench.add_argument("--texts", help="File with one text per line to compare on (default: built-in samples)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(EMBED_MODEL, quantize=not args.no_quantize)
+    else:
+        texts = BENCH_TEXTS
+        if args.texts:
+            with open(args.texts, "r", encoding="utf-8") as f:
+                texts = [line.strip() for line in f if line.strip()]
+        benchmark(args.backends, texts, args.repeats)
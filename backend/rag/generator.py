@@ -1,24 +1,29 @@
 import os
 import sys
 import re
-import textwrap
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from google.api_core.exceptions import ResourceExhausted
+import time
+import asyncio
+import threading
+from collections import deque, Counter
+import numpy as np
 
 try:
-    from .retriever import search
+    from .retriever import search, asearch, search_many, search_executor
+    from .chunker import count_tokens_batch
 except ImportError:
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
     try:
-        from retriever import search
+        from retriever import search, asearch, search_many, search_executor
+        from chunker import count_tokens_batch
     except ImportError:
         try:
-            from rag.retriever import search
+            from rag.retriever import search, asearch, search_many, search_executor
+            from rag.chunker import count_tokens_batch
         except ImportError:
             print("Error: Could not import 'search' from retriever.")
             sys.exit(1)
 
+# Must be set before grpc is first imported (by google.generativeai)
 os.environ["GRPC_VERBOSITY"] = "NONE"
 os.environ["GRPC_ENABLE_FORK_SUPPORT"] = "0"
 
@@ -26,8 +31,6 @@ API_KEY = os.environ.get("GEMINI_API_KEY")
 if not API_KEY:
     print("CRITICAL WARNING: GEMINI_API_KEY is missing.")
 
-genai.configure(api_key=API_KEY)
-
 MODEL_NAME = "gemini-2.5-flash"
 
 SYSTEM_INSTRUCTION = (
@@ -42,69 +45,484 @@ SYSTEM_INSTRUCTION = (
     "Remain factual, context-bound, and do not invent information not supported by the user's input or established LNMIIT details."
 )
 
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-}
+# google.generativeai pulls in grpc and protobuf; configure it on first use
+# (or from the app lifespan) instead of at import.
+_model = None
+_safety_settings = None
+_model_lock = threading.Lock()
 
-model = genai.GenerativeModel(
-    model_name=MODEL_NAME,
-    system_instruction=SYSTEM_INSTRUCTION
-)
+def get_model():
+    """Return (GenerativeModel, safety settings), creating them on first call."""
+    global _model, _safety_settings
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                start = time.perf_counter()
+                import google.generativeai as genai
+                from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+                genai.configure(api_key=API_KEY)
+                _safety_settings = {
+                    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+                    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+                    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+                }
+                _model = genai.GenerativeModel(
+                    model_name=MODEL_NAME,
+                    system_instruction=SYSTEM_INSTRUCTION
+                )
+                print(f"Gemini client ready in {time.perf_counter() - start:.2f}s")
+    return _model, _safety_settings
+
+# --- context assembly ---
+# Retrieval returns CANDIDATE_FACTOR x top_k hits; up to top_k of them are
+# picked by MMR (relevance = the search score, redundancy = cosine between the
+# stored chunk embeddings) until CONTEXT_TOKENS is used up, and picked chunks
+# of the same URL are merged into one passage. Token counts use the embedding
+# tokenizer (see chunker.py), a close proxy for Gemini's.
+CONTEXT_TOKENS = int(os.environ.get("RAG_CONTEXT_TOKENS", "1200"))
+CANDIDATE_FACTOR = int(os.environ.get("RAG_CANDIDATE_FACTOR", "3"))
+MMR_LAMBDA = float(os.environ.get("RAG_MMR_LAMBDA", "0.7"))
+DUPLICATE_SIMILARITY = 0.95     # candidates this close to a picked one are dropped
+_WORD_SET = re.compile(r"\w+")
+
+def candidate_k(top_k):
+    """How many hits to retrieve for a context of at most `top_k` passages."""
+    return max(top_k, top_k * CANDIDATE_FACTOR)
+
+def _similarity_matrix(hits):
+    """Pairwise cosine of the stored embeddings; word-set Jaccard if a hit has none."""
+    if all(h.get("embedding") is not None for h in hits):
+        emb = np.vstack([h["embedding"] for h in hits]).astype(np.float32)
+        return emb @ emb.T
+    words = [set(_WORD_SET.findall(h["content"].lower())) for h in hits]
+    sim = np.zeros((len(hits), len(hits)), dtype=np.float32)
+    for i in range(len(hits)):
+        for j in range(i, len(hits)):
+            union = len(words[i] | words[j])
+            sim[i, j] = sim[j, i] = len(words[i] & words[j]) / union if union else 1.0
+    return sim
+
+def select_passages(results, max_passages, budget=CONTEXT_TOKENS, lam=MMR_LAMBDA):
+    """
+    Maximal marginal relevance over `results`: repeatedly take the hit with
+    the best lam * score - (1 - lam) * (max similarity to those taken), skipping
+    near-duplicates and hits that no longer fit the token budget.
+    Returns [(hit, tokens)] in pick order.
+    """
+    hits = [r for r in results if (r.get("content") or "").strip()]
+    if not hits:
+        return []
+    tokens = count_tokens_batch([h["content"] for h in hits])
+    scores = np.array([h.get("score") or 0.0 for h in hits], dtype=np.float32)
+    sim = _similarity_matrix(hits)
+    redundancy = np.full(len(hits), -np.inf, dtype=np.float32)
+    open_ = np.ones(len(hits), dtype=bool)
+    picked, left = [], budget
+    while open_.any() and len(picked) < max_passages:
+        mmr = lam * scores - (1 - lam) * np.where(np.isfinite(redundancy), redundancy, 0.0)
+        i = int(np.argmax(np.where(open_, mmr, -np.inf)))
+        open_[i] = False
+        if redundancy[i] >= DUPLICATE_SIMILARITY:
+            continue
+        if tokens[i] > left:
+            if picked:
+                continue
+            # Even the best hit alone is over budget: keep its head
+            words = hits[i]["content"].split()
+            keep = max(1, len(words) * left // tokens[i])
+            hits[i] = {**hits[i], "content": " ".join(words[:keep]) + " ..."}
+            tokens[i] = count_tokens_batch([hits[i]["content"]])[0]
+        picked.append((hits[i], tokens[i]))
+        left -= tokens[i]
+        redundancy = np.maximum(redundancy, sim[i])
+    return picked
+
+def _overlap(a, b, min_chars=40, max_chars=600):
+    """Length of the longest suffix of `a` that is a prefix of `b` (min_chars to max_chars)."""
+    for n in range(min(len(a), len(b), max_chars), min_chars - 1, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
 
-def build_context(results):
-    parts = []
-    for r in results:
-        content = r.get("content", "").strip()
-        if not content:
+def merge_passages(picked):
+    """
+    Collapse picked chunks of the same URL into one passage (at the rank of
+    its first chunk): contained chunks are dropped and a chunk that overlaps
+    either end of the passage extends it without repeating the overlap.
+    Returns (passages, chunks merged away).
+    """
+    passages, by_url, merged = [], {}, 0
+    for hit, _ in picked:
+        url = hit.get("url") or ""
+        content = hit["content"].strip()
+        j = by_url.get(url) if url else None
+        if j is None:
+            if url:
+                by_url[url] = len(passages)
+            passages.append({**hit, "content": content})
             continue
-        content = textwrap.shorten(content, width=2500, placeholder=" ...")
-        parts.append(content)
-    return "\n\n".join(parts)
+        merged += 1
+        passage = passages[j]
+        if hit.get("aliases"):
+            passage["aliases"] = sorted(set(passage.get("aliases") or []) | set(hit["aliases"]))
+        if content in passage["content"]:
+            continue
+        if passage["content"] in content:
+            passage["content"] = content
+            continue
+        after, before = _overlap(passage["content"], content), _overlap(content, passage["content"])
+        if after:
+            passage["content"] += content[after:]
+        elif before:
+            passage["content"] = content + passage["content"][before:]
+        else:
+            passage["content"] += "\n" + content
+        passage["score"] = max(passage.get("score") or 0.0, hit.get("score") or 0.0)
+    return passages, merged
+
+def public_hits(hits):
+    """Hits without their embeddings, as returned to clients and cached."""
+    return [{k: v for k, v in h.items() if k != "embedding"} for h in hits]
+
+def build_context(results, max_passages=None, budget=CONTEXT_TOKENS):
+    """(context string, passages used); see select_passages and merge_passages."""
+    picked = select_passages(results, max_passages or len(results), budget)
+    passages, merged = merge_passages(picked)
+    context = "\n\n".join(p["content"] for p in passages)
+    return context, public_hits(passages), merged
+
+class PromptStats:
+    """Per-request prompt sizes: our estimate and, when Gemini reports it, the billed count."""
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.merged_chunks = 0
+        self.estimated = deque(maxlen=window)
+        self.actual = deque(maxlen=window)
+        self.passages = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, estimated, passages, merged):
+        with self._lock:
+            self.requests += 1
+            self.merged_chunks += merged
+            self.estimated.append(estimated)
+            self.passages.append(passages)
+
+    def record_actual(self, prompt_tokens):
+        with self._lock:
+            self.actual.append(prompt_tokens)
+
+    def stats(self):
+        with self._lock:
+            est = np.array(self.estimated) if self.estimated else None
+            return {
+                "context_token_budget": CONTEXT_TOKENS,
+                "requests": self.requests,
+                "merged_chunks": self.merged_chunks,
+                "mean_passages": round(float(np.mean(self.passages)), 2) if self.passages else 0.0,
+                "prompt_tokens_mean": round(float(est.mean()), 1) if est is not None else 0.0,
+                "prompt_tokens_p95": float(np.percentile(est, 95)) if est is not None else 0.0,
+                "gemini_prompt_tokens_mean": round(float(np.mean(self.actual)), 1) if self.actual else None,
+            }
+
+prompt_stats = PromptStats()
+
+# --- retrieval-confidence gate ---
+# If even the best hit scores below MIN_SCORE the question is not covered by
+# the index: answer NOT_FOUND without calling Gemini. Otherwise top_k shrinks
+# to the hits above the largest drop between consecutive scores when that
+# drop is at least SCORE_GAP. Scores are cosine similarities (all-MiniLM-L6-v2);
+# tune both against a query log with `python rag/generator.py --gate-report`.
+MIN_SCORE = float(os.environ.get("RAG_MIN_SCORE", "0.25"))
+SCORE_GAP = float(os.environ.get("RAG_SCORE_GAP", "0.12"))
+NOT_FOUND = "I couldn't find relevant information."
+
+def gate_results(results, top_k, min_score=MIN_SCORE, score_gap=SCORE_GAP):
+    """
+    (candidates to build the context from, passages to use), with 0 passages
+    when the query should not reach the LLM. Candidates below the floor, or
+    below a clear score gap, are dropped.
+    """
+    results = [r for r in results if (r.get("score") or 0.0) >= min_score]
+    if not results:
+        return [], 0
+    scores = [r["score"] for r in results[:top_k]]
+    gaps = [a - b for a, b in zip(scores, scores[1:])]
+    if gaps and max(gaps) >= score_gap:
+        k = gaps.index(max(gaps)) + 1
+        cutoff = scores[k - 1]
+        return [r for r in results if r["score"] >= cutoff], k
+    return results, top_k
+
+class GateStats:
+    """How often the gate skipped the LLM or shrank top_k, and the best-score distribution."""
+
+    def __init__(self):
+        self.requests = 0
+        self.skipped = 0
+        self.trimmed = 0
+        self.passages_saved = 0
+        self.best_scores = Counter()    # best hit score, in 0.05 buckets
+        self._lock = threading.Lock()
+
+    def record(self, results, top_k, k):
+        best = max((r.get("score") or 0.0 for r in results), default=0.0)
+        with self._lock:
+            self.requests += 1
+            self.best_scores[int(best * 20 + 1e-9) / 20] += 1
+            if k == 0:
+                self.skipped += 1
+            elif k < top_k:
+                self.trimmed += 1
+                self.passages_saved += top_k - k
+
+    def stats(self):
+        with self._lock:
+            return {
+                "min_score": MIN_SCORE,
+                "score_gap": SCORE_GAP,
+                "requests": self.requests,
+                "llm_skipped": self.skipped,
+                "skip_rate": round(self.skipped / self.requests, 4) if self.requests else 0.0,
+                "top_k_trimmed": self.trimmed,
+                "trim_rate": round(self.trimmed / self.requests, 4) if self.requests else 0.0,
+                "passages_saved": self.passages_saved,
+                "best_score_histogram": {f"{b:.2f}": n for b, n in sorted(self.best_scores.items())},
+            }
+
+gate_stats = GateStats()
+
+def apply_gate(query, results, top_k):
+    """gate_results plus bookkeeping; logs queries that skip the LLM."""
+    candidates, k = gate_results(results, top_k)
+    gate_stats.record(results, top_k, k)
+    if k == 0:
+        best = max((r.get("score") or 0.0 for r in results), default=0.0)
+        print(f"Gate: no hit above {MIN_SCORE} (best {best:.3f}); skipping LLM for {query!r}")
+    return candidates, k
+
+def gate_report(queries, top_k=5, floors=(0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5),
+                gaps=(0.08, 0.12, 0.16, 0.2)):
+    """
+    Skip and trim rates the gate would have on `queries` (e.g. a query log)
+    for a grid of floors and gaps. One retrieval per query, no LLM calls.
+    """
+    hits = search_many(list(queries), top_k=candidate_k(top_k))
+    print(f"{len(queries)} queries, top_k={top_k}")
+    print("floor | " + " | ".join(f"gap {g:.2f}: skip% / trim%" for g in gaps))
+    for floor in floors:
+        cells = []
+        for gap in gaps:
+            ks = [gate_results(h, top_k, floor, gap)[1] for h in hits]
+            skipped = sum(k == 0 for k in ks) / max(len(ks), 1)
+            trimmed = sum(0 < k < top_k for k in ks) / max(len(ks), 1)
+            cells.append(f"{100 * skipped:11.1f} / {100 * trimmed:5.1f}")
+        print(f"{floor:5.2f} | " + " | ".join(cells))
+
+MAX_SENTENCES = 5
+MAX_WORDS = 120
+_SENTENCE_END = re.compile(r"[.!?](?= )")
+_WORD = re.compile(r"\S+")
 
 def enforce_short_answer(text):
     text = text.strip()
     sentences = re.split(r'(?<=[.!?]) +', text)
-    if len(sentences) > 5:
-        text = " ".join(sentences[:5])
+    if len(sentences) > MAX_SENTENCES:
+        text = " ".join(sentences[:MAX_SENTENCES])
     words = text.split()
-    if len(words) > 120:
-        text = " ".join(words[:120]) + "..."
+    if len(words) > MAX_WORDS:
+        text = " ".join(words[:MAX_WORDS]) + "..."
     return text
 
-def answer_with_gemini(query, top_k=5):
-    try:
-        results = search(query, top_k=top_k)
-    except Exception as e:
-        return f"Error during retrieval: {e}", []
+def find_answer_cut(text):
+    """
+    Streaming counterpart of `enforce_short_answer`: returns (end, truncated_by_words)
+    once `text` has gone past the sentence or word limit, else None.
+    A limit only counts as reached when the text after it has started, so a
+    partial answer never gets cut early.
+    """
+    cuts = []
+    ends = [m.end() for m in _SENTENCE_END.finditer(text)]
+    if len(ends) >= MAX_SENTENCES:
+        cuts.append((ends[MAX_SENTENCES - 1], False))
+    words = [m.end() for m in _WORD.finditer(text)]
+    if len(words) > MAX_WORDS:
+        cuts.append((words[MAX_WORDS - 1], True))
+    return min(cuts) if cuts else None
 
-    if not results:
-        return "I couldn't find relevant information.", []
+GENERATION_CONFIG = {"temperature": 0.3, "max_output_tokens": 2000}
 
-    context_str = build_context(results)
+def build_prompt(query, results, max_passages=None):
+    """(prompt, passages used) for the retrieved `results`; logs the prompt size."""
+    context_str, passages, merged = build_context(results, max_passages)
     prompt = (
         f"USER QUESTION: {query}\n\n"
         f"CONTEXT:\n{context_str}\n\n"
         "Based strictly on the context above, answer concisely."
     )
+    n_tokens = count_tokens_batch([prompt])[0]
+    prompt_stats.record(n_tokens, len(passages), merged)
+    print(f"Prompt: ~{n_tokens} tokens, {len(passages)} passages from {len(results)} hits"
+          + (f" ({merged} chunks merged)" if merged else ""))
+    return prompt, passages
 
+async def abuild_prompt(query, results, max_passages=None):
+    """build_prompt on the search pool: it tokenizes every candidate, which must not stall the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_executor, build_prompt, query, results, max_passages)
+
+def _record_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and getattr(usage, "prompt_token_count", None):
+        prompt_stats.record_actual(usage.prompt_token_count)
+
+def _finish(response, results):
+    _record_usage(response)
+    if not response.candidates:
+        return "Error: No response returned.", []
+    return enforce_short_answer(response.text), results
+
+def _generation_error(e):
+    from google.api_core.exceptions import ResourceExhausted
+    if isinstance(e, ResourceExhausted):
+        return "Service is currently overloaded (Rate Limit Reached). Please try again later."
+    return f"Error generating response: {str(e)}"
+
+def generate_answer(query, results, max_passages=None):
+    """Blocking Gemini call for already-retrieved results."""
     try:
+        model, safety_settings = get_model()
+        prompt, passages = build_prompt(query, results, max_passages)
         response = model.generate_content(
             prompt,
-            generation_config={"temperature": 0.3, "max_output_tokens": 2000},
-            safety_settings=SAFETY_SETTINGS
+            generation_config=GENERATION_CONFIG,
+            safety_settings=safety_settings
+        )
+        return _finish(response, passages)
+    except Exception as e:
+        return _generation_error(e), []
+
+async def generate_answer_async(query, results, raise_errors=False, max_passages=None):
+    """Same as `generate_answer` but through the async Gemini client, so a
+    request waiting on the LLM holds no thread. With `raise_errors` failures
+    propagate instead of being turned into an answer string."""
+    try:
+        model, safety_settings = get_model()
+        prompt, passages = await abuild_prompt(query, results, max_passages)
+        response = await model.generate_content_async(
+            prompt,
+            generation_config=GENERATION_CONFIG,
+            safety_settings=safety_settings
+        )
+        if raise_errors and not response.candidates:
+            raise RuntimeError("No response returned.")
+        return _finish(response, passages)
+    except Exception as e:
+        if raise_errors:
+            raise
+        return _generation_error(e), []
+
+def answer_with_gemini(query, top_k=5):
+    try:
+        results = search(query, top_k=candidate_k(top_k))
+    except Exception as e:
+        return f"Error during retrieval: {e}", []
+
+    results, k = apply_gate(query, results, top_k)
+    if not k:
+        return NOT_FOUND, []
+
+    return generate_answer(query, results, max_passages=k)
+
+async def answer_with_gemini_async(query, top_k=5):
+    try:
+        results = await asearch(query, top_k=candidate_k(top_k))
+    except Exception as e:
+        return f"Error during retrieval: {e}", []
+
+    results, k = apply_gate(query, results, top_k)
+    if not k:
+        return NOT_FOUND, []
+
+    return await generate_answer_async(query, results, max_passages=k)
+
+async def stream_answer_with_gemini(query, top_k=5):
+    """
+    Async generator of (event, data) pairs: ("sources", results) as soon as
+    retrieval returns, then ("token", text) deltas, then ("done", answer).
+    Failures are reported as ("error", message).
+    We stop reading from Gemini as soon as the answer limits are reached.
+    """
+    try:
+        results = await asearch(query, top_k=candidate_k(top_k))
+    except Exception as e:
+        yield "error", f"Error during retrieval: {e}"
+        return
+
+    results, k = apply_gate(query, results, top_k)
+    if not k:
+        yield "sources", []
+        yield "done", NOT_FOUND
+        return
+    prompt, passages = await abuild_prompt(query, results, max_passages=k)
+    yield "sources", passages
+
+    buffer = ""
+    emitted = ""
+    usage_recorded = False
+    try:
+        model, safety_settings = get_model()
+        response = await model.generate_content_async(
+            prompt,
+            generation_config=GENERATION_CONFIG,
+            safety_settings=safety_settings,
+            stream=True
         )
-        if not response.candidates:
-            return "Error: No response returned.", []
-        return enforce_short_answer(response.text), results
-    except ResourceExhausted:
-        return "Service is currently overloaded (Rate Limit Reached). Please try again later.", []
+        async for chunk in response:
+            if not usage_recorded and getattr(chunk, "usage_metadata", None) is not None:
+                # Every streamed chunk repeats the prompt token count; take the first
+                _record_usage(chunk)
+                usage_recorded = True
+            try:
+                buffer += chunk.text
+            except ValueError:
+                # Chunks without text parts (finish reason / safety metadata)
+                continue
+
+            text = buffer.lstrip()
+            cut = find_answer_cut(text)
+            if cut is not None:
+                end, truncated = cut
+                answer = text[:end] + ("..." if truncated else "")
+                yield "token", answer[len(emitted):]
+                yield "done", answer
+                # Leaving the loop drops the response iterator, which cancels
+                # the remaining generation.
+                return
+
+            # Hold back trailing whitespace: it may end up past a cut point.
+            visible = text.rstrip()
+            if len(visible) > len(emitted):
+                yield "token", visible[len(emitted):]
+                emitted = visible
     except Exception as e:
-        return f"Error generating response: {str(e)}", []
+        yield "error", _generation_error(e)
+        return
+
+    if not buffer.strip():
+        yield "error", "Error: No response returned."
+        return
+    yield "done", emitted
 
 if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--gate-report":
+        # One query per line, e.g. exported from the API logs
+        with open(sys.argv[2], "r", encoding="utf-8") as f:
+            gate_report([line.strip() for line in f if line.strip()])
+        sys.exit(0)
     while True:
         try:
             q = input("\nAsk me something about LNMIIT (or 'exit'): ").strip()
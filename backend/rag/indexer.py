@@ -1,11 +1,18 @@
 # indexer.py  (Milvus-Lite + sentence-transformers)
 
-import os, json, hashlib
+import os, json, hashlib, time, uuid, argparse, itertools
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
 import numpy as np
 from tqdm import tqdm
-import torch
+
+try:
+    from .embedding_store import EmbeddingStore, text_hash
+    from .encoder import get_encoder, ENCODER_BACKEND, ENCODER_BACKENDS
+    from .vector_store import NumpyStoreWriter, VECTOR_BACKEND
+except ImportError:
+    from embedding_store import EmbeddingStore, text_hash
+    from encoder import get_encoder, ENCODER_BACKEND, ENCODER_BACKENDS
+    from vector_store import NumpyStoreWriter, VECTOR_BACKEND
 
 from pymilvus import (
     connections, Collection, FieldSchema, CollectionSchema,
@@ -24,26 +31,39 @@ INDEX_DIR.mkdir(exist_ok=True)
 EMBED_MODEL = "all-MiniLM-L6-v2"
 EMB_DIM = 384
 COLLECTION_NAME = "lnmiit_rag"
+ALIASES_MAX_BYTES = 8192
 
-def load_documents():
-    docs = []
+def iter_documents():
+    """Yield processed chunks one at a time, reading JSONL files line by line."""
     if not DATA_DIR.exists():
         print(f"Processed directory does not exist: {DATA_DIR}")
-        return []
+        return
 
     for fn in sorted(DATA_DIR.iterdir()):
-        if not fn.name.lower().endswith((".json", ".jsonl", ".ndjson", ".jsonlines")):
+        name = fn.name.lower()
+        if not name.endswith((".json", ".jsonl", ".ndjson", ".jsonlines")):
             continue
 
         with open(fn, "r", encoding="utf-8") as f:
-            try:
-                arr = json.load(f)
-            except Exception:
-                f.seek(0)
-                arr = [json.loads(line) for line in f if line.strip()]
-
-        docs.extend(arr)
+            head = f.read(64).lstrip()
+            f.seek(0)
+            # Older processor output is a JSON array even in .jsonl files
+            if name.endswith(".json") or head.startswith("["):
+                # JSON arrays can only be parsed whole; bounded by one file
+                try:
+                    arr = json.load(f)
+                except Exception:
+                    f.seek(0)
+                    arr = [json.loads(line) for line in f if line.strip()]
+                yield from arr
+                continue
+
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
 
+def load_documents():
+    docs = list(iter_documents())
     print(f"Loaded {len(docs)} processed chunks.")
     return docs
 
@@ -64,6 +84,9 @@ def create_collection(dim=EMB_DIM):
         FieldSchema(name="content", dtype=DataType.VARCHAR, max_length=5000),
         FieldSchema(name="url", dtype=DataType.VARCHAR, max_length=500),
         FieldSchema(name="title", dtype=DataType.VARCHAR, max_length=500),
+        FieldSchema(name="content_hash", dtype=DataType.VARCHAR, max_length=64),
+        # URLs of near-duplicates dropped by the processor, as a JSON list
+        FieldSchema(name="aliases", dtype=DataType.VARCHAR, max_length=ALIASES_MAX_BYTES),
     ]
 
     schema = CollectionSchema(fields, description="LNMIIT RAG collection")
@@ -85,61 +108,283 @@ def safe_id(raw_id: str, index: int) -> str:
     return h[:40]          # 40 characters, guaranteed < 200
 
 
-def build_index(batch_size=64):
-    connect_milvus()
+def write_index_version():
+    """Stamp a new index version; the API's answer cache drops everything when it changes."""
+    version = {"version": f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}",
+               "built_at": time.time()}
+    tmp_path = INDEX_DIR / "index_version.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(version, f)
+    os.replace(tmp_path, INDEX_DIR / "index_version.json")
+    print("Index version:", version["version"])
+
+
+def aliases_json(aliases):
+    """JSON list for the Milvus aliases field, dropping URLs past ALIASES_MAX_BYTES."""
+    aliases = list(aliases)
+    while len(json.dumps(aliases, ensure_ascii=False).encode("utf-8")) > ALIASES_MAX_BYTES:
+        aliases = aliases[:len(aliases) // 2]
+    return json.dumps(aliases, ensure_ascii=False)
+
+
+def content_hash(content, url, title, aliases=()):
+    """Hash of everything stored for a chunk; a changed hash means re-embed + upsert."""
+    h = hashlib.sha1()
+    for part in (content, url, title):
+        h.update((part or "").encode("utf-8"))
+        h.update(b"\x00")
+    if aliases:
+        # Only hashed when present, so chunks without aliases keep their old hash
+        h.update(json.dumps(sorted(aliases)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def open_existing_collection(dim):
+    """
+    Return the current collection if it can be updated in place (has a
+    content_hash field and the same embedding dim), else None.
+    """
+    if not utility.has_collection(COLLECTION_NAME):
+        print("No existing collection, building from scratch.")
+        return None
+    collection = Collection(COLLECTION_NAME)
+    fields = {f.name: f for f in collection.schema.fields}
+    if "content_hash" not in fields:
+        print("Existing collection has no content hashes, rebuilding.")
+        return None
+    if "aliases" not in fields:
+        print("Existing collection has no aliases field, rebuilding.")
+        return None
+    if int(fields["embedding"].params.get("dim", 0)) != dim:
+        print("Embedding dim changed, rebuilding.")
+        return None
+    collection.load()
+    return collection
+
 
-    docs = load_documents()
-    if not docs:
+def fetch_existing_hashes(collection, batch_size=1000):
+    existing = {}
+    it = collection.query_iterator(batch_size=batch_size, expr='id != ""', output_fields=["content_hash"])
+    while True:
+        rows = it.next()
+        if not rows:
+            it.close()
+            break
+        for row in rows:
+            existing[row["id"]] = row.get("content_hash", "")
+    return existing
+
+
+def embed_texts(encoder, texts, batch_size=64, store=None):
+    """
+    Normalised float32 embeddings for `texts`. With an EmbeddingStore, texts
+    embedded by an earlier run (same model) are read back instead of encoded,
+    and each distinct text is encoded at most once.
+    """
+    if store is not None:
+        hashes = [text_hash(t) for t in texts]
+        vectors, found = store.get_many(hashes)
+    else:
+        hashes = list(range(len(texts)))
+        vectors, found = np.zeros((len(texts), encoder.dim), dtype="float32"), np.zeros(len(texts), dtype=bool)
+
+    # First position of every distinct text that still needs encoding
+    todo = {}
+    for i, h in enumerate(hashes):
+        if not found[i] and h not in todo:
+            todo[h] = i
+    todo_idx = list(todo.values())
+
+    index_batches = [todo_idx[i:i+batch_size] for i in range(0, len(todo_idx), batch_size)]
+    text_batches = [[texts[i] for i in idx] for idx in index_batches]
+    # encode_batches yields in input order, also when sharded over a process pool
+    for idx, emb in zip(index_batches, encoder.encode_batches(text_batches)):
+        vectors[idx] = emb
+        if store is not None:
+            store.add_many([hashes[i] for i in idx], emb)
+
+    # Duplicates of a text encoded in this call
+    for i, h in enumerate(hashes):
+        if not found[i] and todo[h] != i:
+            vectors[i] = vectors[todo[h]]
+
+    return vectors
+
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def report_embedding(embedded, embed_time, workers, store):
+    if embedded:
+        print(f"Embedded {embedded} chunks in {embed_time:.1f}s "
+              f"({embedded / max(embed_time, 1e-9):.1f} chunks/sec, {workers} worker(s))")
+    if store is not None:
+        print(f"Embedding cache: {store.hits} hits, {store.misses} misses "
+              f"({store.hit_rate():.1%} hit rate)")
+
+
+def build_index(batch_size=64, incremental=False, use_cache=True, insert_batch=1024, flush_every=16384, workers=1,
+                backend=VECTOR_BACKEND, quantization="none", encoder_backend=ENCODER_BACKEND):
+    """
+    Stream processed chunks through embedding into the vector store: `insert_batch`
+    chunks are read, embedded and inserted at a time, Milvus is flushed every
+    `flush_every` rows and meta.jsonl is appended as we go, so peak memory
+    does not grow with the corpus. `workers` > 1 embeds on a CPU process pool.
+    backend="numpy" writes the memory-mapped NumPy store instead of Milvus;
+    it is always rebuilt whole, with unchanged chunks served from the embedding cache,
+    and can carry an int8/binary copy of the vectors (`quantization`) for coarse search.
+    `encoder_backend` picks torch or ONNX Runtime for embedding; the retriever
+    must use the same one (RAG_ENCODER_BACKEND).
+    """
+    docs_iter = iter_documents()
+    first = next(docs_iter, None)
+    if first is None:
         print("No processed documents found.")
         return
-
-    # Device
-    device = "mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"
-    print("Using device:", device)
-
-    model = SentenceTransformer(EMBED_MODEL, device=device)
-    dim = model.get_sentence_embedding_dimension()
+    docs_iter = itertools.chain([first], docs_iter)
+
+    if backend not in ("milvus", "numpy"):
+        raise ValueError(f"Unknown vector backend: {backend!r}")
+    if backend == "milvus":
+        if quantization != "none":
+            raise ValueError("Quantized vectors are only supported by the numpy backend")
+        connect_milvus()
+
+    encoder = get_encoder(EMBED_MODEL, workers, encoder_backend)
+    print(f"Using {encoder_backend} encoder on device:", encoder.device)
+    dim = encoder.dim
     print("Embedding dim:", dim)
+    if workers > 1:
+        # Enough batches per step to keep every worker busy
+        insert_batch = max(insert_batch, batch_size * workers * 4)
+
+    collection, np_writer, existing = None, None, {}
+    if backend == "numpy":
+        np_writer = NumpyStoreWriter(dim, encoder.key, quantization=quantization)
+    else:
+        collection = open_existing_collection(dim) if incremental else None
+        existing = fetch_existing_hashes(collection) if collection is not None else {}
+        if collection is None:
+            collection = create_collection(dim)
+
+    store = EmbeddingStore(encoder.key, dim) if use_cache else None
+    meta_path = INDEX_DIR / "meta.jsonl"
+    meta_tmp = INDEX_DIR / "meta.jsonl.tmp"
+
+    seen_ids = set()
+    total = unchanged = changed = new = 0
+    embedded, embed_time = 0, 0.0
+    since_flush = 0
+    pbar = tqdm(desc="Indexing", unit="chunk")
+    try:
+        with open(meta_tmp, "w", encoding="utf-8") as meta_f:
+            for docs in iter_batches(docs_iter, insert_batch):
+                ids, contents, urls, titles, hashes, aliases = [], [], [], [], [], []
+                for d in docs:
+                    _id = safe_id(d.get("id"), total)
+                    total += 1
+                    if _id in seen_ids:
+                        continue    # first occurrence of an id wins
+                    seen_ids.add(_id)
+                    meta_f.write(json.dumps(d, ensure_ascii=False) + "\n")
+
+                    content, url, title = d["content"], d.get("url", ""), d.get("title", "")
+                    alias = d.get("aliases") or []
+                    h = content_hash(content, url, title, alias)
+                    if existing.get(_id) == h:
+                        unchanged += 1
+                        continue
+                    if _id in existing:
+                        changed += 1
+                    else:
+                        new += 1
+                    ids.append(_id)
+                    contents.append(content)
+                    urls.append(url)
+                    titles.append(title)
+                    hashes.append(h)
+                    aliases.append(alias)
+
+                if ids:
+                    start = time.perf_counter()
+                    vectors = embed_texts(encoder, contents, batch_size, store)
+                    embed_time += time.perf_counter() - start
+                    embedded += len(ids)
+                    if np_writer is not None:
+                        np_writer.add(ids, vectors, contents, urls, titles, aliases)
+                        pbar.update(len(docs))
+                        continue
+                    # Rows go to pymilvus as float32 arrays, not nested Python float lists
+                    columns = [ids, list(vectors), contents, urls, titles, hashes, [aliases_json(a) for a in aliases]]
+                    if existing:
+                        collection.upsert(columns)
+                    else:
+                        collection.insert(columns)
+                    since_flush += len(ids)
+                    if since_flush >= flush_every:
+                        collection.flush()
+                        since_flush = 0
+                pbar.update(len(docs))
+    finally:
+        pbar.close()
+        encoder.close()
+        if store is not None:
+            store.close()
+
+    os.replace(meta_tmp, meta_path)
+
+    if np_writer is not None:
+        np_writer.close()
+        print(f"Chunks: {len(seen_ids)} total")
+        report_embedding(embedded, embed_time, workers, store)
+        write_index_version()
+        return
 
-    collection = create_collection(dim)
-
-    # Extract fields
-    contents = [d["content"] for d in docs]
-    ids = [safe_id(d.get("id"), i) for i, d in enumerate(docs)]
-    urls = [d.get("url", "") for d in docs]
-    titles = [d.get("title", "") for d in docs]
-
-    # Embeddings
-    all_embeddings = []
-
-    for i in tqdm(range(0, len(contents), batch_size), desc="Embedding"):
-        batch = contents[i:i+batch_size]
-        emb = model.encode(batch, show_progress_bar=False, convert_to_numpy=True)
-
-        norms = np.linalg.norm(emb, axis=1, keepdims=True)
-        emb = emb / (norms + 1e-10)
-
-        all_embeddings.append(emb)
+    removed_ids = [i for i in existing if i not in seen_ids]
+    for i in range(0, len(removed_ids), 500):
+        batch = removed_ids[i:i+500]
+        collection.delete(expr=f"id in {json.dumps(batch)}")
 
-    vectors = np.vstack(all_embeddings).astype("float32")
+    print(f"Chunks: {len(seen_ids)} total, {unchanged} unchanged, {changed} changed, "
+          f"{new} new, {len(removed_ids)} removed")
+    report_embedding(embedded, embed_time, workers, store)
 
-    # Insert into Milvus
-    print("Inserting vectors into Milvus...")
-    collection.insert([
-        ids,
-        vectors.tolist(),
-        contents,
-        urls,
-        titles,
-    ])
+    if not (changed or new or removed_ids):
+        print("Index already up to date.")
+        return
 
     collection.flush()
     print("Milvus index built and data inserted successfully.")
-
-    # Save metadata
-    meta_path = INDEX_DIR / "meta.json"
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(docs, f, ensure_ascii=False, indent=2)
+    write_index_version()
 
 if __name__ == "__main__":
-    build_index()
+    parser = argparse.ArgumentParser(description="Embed processed chunks into the vector store")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only embed new/changed chunks and delete removed ones instead of rebuilding")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--insert-batch", type=int, default=1024,
+                        help="Chunks read, embedded and inserted per step")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Embedding processes on CPU (one model replica each); 0 = one per core")
+    parser.add_argument("--backend", choices=["milvus", "numpy"], default=VECTOR_BACKEND,
+                        help="Vector store to build (default: RAG_VECTOR_BACKEND or milvus)")
+    parser.add_argument("--quantize", choices=["none", "int8", "binary"], default="none",
+                        help="numpy backend: also store int8 (4x) or binary (32x smaller) vectors for coarse search")
+    parser.add_argument("--encoder", choices=ENCODER_BACKENDS, default=ENCODER_BACKEND,
+                        help="Embedding runtime (default: RAG_ENCODER_BACKEND or torch); onnx needs `python rag/encoder.py export`")
+    parser.add_argument("--no-embedding-cache", action="store_true",
+                        help="Encode every chunk instead of reusing data/embedding_cache")
+    args = parser.parse_args()
+
+    build_index(batch_size=args.batch_size, incremental=args.incremental,
+                use_cache=not args.no_embedding_cache, insert_batch=args.insert_batch,
+                workers=args.workers or os.cpu_count() or 1, backend=args.backend,
+                quantization=args.quantize, encoder_backend=args.encoder)
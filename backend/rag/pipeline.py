@@ -1,14 +1,139 @@
-from .retriever import search
-from .generator import answer_with_gemini
+import os
+import asyncio
+from .retriever import search, embed_query, aembed_query, asearch_many
+from .generator import (answer_with_gemini, answer_with_gemini_async, stream_answer_with_gemini, generate_answer_async,
+                        candidate_k, apply_gate, NOT_FOUND)
+from .cache import AnswerCache, normalize_query
 
-def rag_pipeline(query: str):
-    answer, sources = answer_with_gemini(query)
+# Max Gemini calls in flight for one /chat/batch request
+BATCH_LLM_CONCURRENCY = int(os.environ.get("RAG_BATCH_LLM_CONCURRENCY", "8"))
+
+# Shared by every endpoint in this process; see cache.py for the knobs.
+answer_cache = AnswerCache()
+
+def _result(query, answer, sources):
     return {
         "query": query,
         "response": answer,
         "sources": sources
     }
 
+def _cacheable(sources):
+    # Errors and "not found" answers come back without sources; never cache those.
+    return bool(sources)
+
+def rag_pipeline(query: str):
+    cached = answer_cache.get_exact(query)
+    embedding = None
+    if cached is None:
+        if answer_cache.semantic:
+            embedding = embed_query(query)
+        cached = answer_cache.get(query, embedding)
+    if cached is not None:
+        return _result(query, *cached)
+
+    answer, sources = answer_with_gemini(query)
+    if _cacheable(sources):
+        answer_cache.put(query, answer, sources, embedding)
+    return _result(query, answer, sources)
+
+async def _cache_lookup_async(query):
+    cached = answer_cache.get_exact(query)
+    embedding = None
+    if cached is None:
+        if answer_cache.semantic:
+            embedding = await aembed_query(query)
+        cached = answer_cache.get(query, embedding)
+    return cached, embedding
+
+async def rag_pipeline_async(query: str):
+    cached, embedding = await _cache_lookup_async(query)
+    if cached is not None:
+        return _result(query, *cached)
+
+    answer, sources = await answer_with_gemini_async(query)
+    if _cacheable(sources):
+        answer_cache.put(query, answer, sources, embedding)
+    return _result(query, answer, sources)
+
+async def rag_pipeline_stream(query: str):
+    """Yields (event, payload) pairs for the SSE endpoint."""
+    cached, embedding = await _cache_lookup_async(query)
+    if cached is not None:
+        answer, sources = cached
+        yield "sources", {"query": query, "sources": sources}
+        yield "token", {"text": answer}
+        yield "done", {"query": query, "response": answer}
+        return
+
+    sources = []
+    async for event, data in stream_answer_with_gemini(query):
+        if event == "sources":
+            sources = data
+            yield event, {"query": query, "sources": data}
+        elif event == "token":
+            yield event, {"text": data}
+        elif event == "done":
+            if _cacheable(sources):
+                answer_cache.put(query, data, sources, embedding)
+            yield event, {"query": query, "response": data}
+        else:
+            yield event, {"detail": data}
+
+async def rag_pipeline_batch(queries, top_k=5, concurrency=BATCH_LLM_CONCURRENCY):
+    """
+    Answer many queries at once: exact cache hits are served directly, the
+    rest are retrieved in bulk with search_many and the Gemini calls are fanned
+    out with at most `concurrency` in flight. Results keep the input order and
+    carry an "error" field (None on success).
+    """
+    results = [None] * len(queries)
+    pending = []
+    duplicates = {}     # index -> index of the first identical query
+    first_seen = {}
+    for i, query in enumerate(queries):
+        key = normalize_query(query)
+        if key in first_seen:
+            duplicates[i] = first_seen[key]
+            continue
+        first_seen[key] = i
+        cached = answer_cache.get_exact(query)
+        if cached is not None:
+            results[i] = {**_result(query, *cached), "error": None}
+        else:
+            pending.append(i)
+
+    try:
+        retrieved = await asearch_many([queries[i] for i in pending], top_k=candidate_k(top_k),
+                                       with_embeddings=True)
+    except Exception as e:
+        for i in pending:
+            results[i] = {**_result(queries[i], None, []), "error": f"Error during retrieval: {e}"}
+        retrieved = []
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def answer_one(i, embedding, hits):
+        query = queries[i]
+        hits, k = apply_gate(query, hits, top_k)
+        if not k:
+            results[i] = {**_result(query, NOT_FOUND, []), "error": None}
+            return
+        async with semaphore:
+            try:
+                answer, sources = await generate_answer_async(query, hits, raise_errors=True, max_passages=k)
+            except Exception as e:
+                results[i] = {**_result(query, None, []), "error": str(e)}
+                return
+        if _cacheable(sources):
+            answer_cache.put(query, answer, sources, embedding)
+        results[i] = {**_result(query, answer, sources), "error": None}
+
+    await asyncio.gather(*(answer_one(i, embedding, hits) for i, (embedding, hits) in zip(pending, retrieved)))
+    for i, j in duplicates.items():
+        results[i] = {**results[j], "query": queries[i]}
+    return results
+
 if __name__ == "__main__":
     
     res = rag_pipeline("What is the placement record?")
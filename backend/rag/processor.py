@@ -2,52 +2,55 @@
 import os
 import json
 import re
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 from datetime import datetime, timezone
 
 from pathlib import Path
+
+try:
+    from .crawl_state import load_manifest, MANIFEST_PATH
+    from .dedupe import dedupe_corpus, save_signatures, sig_path, DEDUPE_THRESHOLD
+    from .chunker import split_chunks, tokenizer_name, CHUNK_TOKENS
+except ImportError:
+    from crawl_state import load_manifest, MANIFEST_PATH
+    from dedupe import dedupe_corpus, save_signatures, sig_path, DEDUPE_THRESHOLD
+    from chunker import split_chunks, tokenizer_name, CHUNK_TOKENS
+
 BASE_DIR = Path(__file__).parent.parent # This is backend/
 RAW_DIR = BASE_DIR / "data" / "raw"
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
-CHUNK_CHAR_SIZE = 2000
-MIN_CHUNK_CHAR = 200
 
 def ensure_dirs():
     os.makedirs(RAW_DIR, exist_ok=True)
     os.makedirs(PROCESSED_DIR, exist_ok=True)
 
+def html_to_text(raw_html: str) -> str:
+    """Visible text of an HTML fragment (lxml; BeautifulSoup if lxml cannot parse it)."""
+    try:
+        tree = lxml.html.fragment_fromstring(raw_html, create_parent="div")
+    except (etree.ParserError, ValueError):
+        return BeautifulSoup(raw_html, "html.parser").get_text(separator=" ", strip=True)
+    for el in list(tree.iter("script", "style", "template")):
+        el.drop_tree()
+    return " ".join(t.strip() for t in tree.itertext() if t.strip())
+
 def clean_html_or_text(raw_text: str) -> str:
     if not raw_text:
         return ""
     if "<" in raw_text and ">" in raw_text and (raw_text.lstrip().startswith("<") or "<p" in raw_text or "<div" in raw_text):
-        soup = BeautifulSoup(raw_text, "html.parser")
-        text = soup.get_text(separator=" ", strip=True)
+        text = html_to_text(raw_text)
     else:
         text = raw_text
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
-
-def chunk_text(content: str, size: int = CHUNK_CHAR_SIZE, min_size: int = MIN_CHUNK_CHAR):
-    if not content:
-        return []
-    if len(content) <= size:
-        return [content]
-    sentences = re.split(r'(?<=[\.\?\!])\s+', content)
-    chunks = []
-    current = ""
-    for s in sentences:
-        if len(current) + len(s) + 1 <= size:
-            current = (current + " " + s).strip()
-        else:
-            if current:
-                chunks.append(current)
-            current = s
-    if current:
-        chunks.append(current)
-    if len(chunks) > 1 and len(chunks[-1]) < min_size:
-        chunks[-2] = chunks[-2] + " " + chunks[-1]
-        chunks = chunks[:-1]
-    return chunks
+    # Keep line breaks: the chunker uses them for paragraphs and headings
+    text = re.sub(r"[^\S\n]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
 
 def normalize_item(item: dict):
     _id = item.get("id") or item.get("url") or None
@@ -62,8 +65,8 @@ def normalize_item(item: dict):
     cleaned = clean_html_or_text(raw_text)
 
     processed_entries = []
-    chunks = chunk_text(cleaned)
-    for i, chunk in enumerate(chunks):
+    chunks = split_chunks(cleaned)
+    for i, (chunk, n_tokens) in enumerate(chunks):
         proc = {
             "id": f"{_id}::chunk_{i}" if _id else None,
             "source_id": _id,
@@ -75,6 +78,7 @@ def normalize_item(item: dict):
             "source_type": source_type,
             "processed_at": datetime.now(timezone.utc).isoformat(),
             "content_len": len(chunk),
+            "tokens": n_tokens,
         }
         processed_entries.append(proc)
     return processed_entries
@@ -117,11 +121,9 @@ def load_json_or_jsonl(path: str):
                 return []
     return items
 
-def process_file(path_in: str, path_out: str):
+def process_items(path_in: str):
+    """Cleaned, chunked entries of one raw file, without repeats inside the file."""
     items = load_json_or_jsonl(path_in)
-    if not items:
-        return 0
-
     all_processed = []
     seen_texts = set()
     for item in items:
@@ -132,27 +134,179 @@ def process_file(path_in: str, path_out: str):
                 continue
             seen_texts.add(h)
             all_processed.append(p)
+    return all_processed
 
+def write_jsonl(entries, out_f):
+    for p in entries:
+        out_f.write(json.dumps(p, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+def process_file(path_in: str, path_out: str):
+    entries = process_items(path_in)
+    if not entries:
+        return 0
     with open(path_out, "w", encoding="utf-8") as out_f:
-        json.dump(all_processed, out_f, ensure_ascii=False, indent=2)
+        write_jsonl(entries, out_f)
+    return len(entries)
+
+def consume_manifest():
+    """Keep the applied manifest next to the pending one, for inspection."""
+    if os.path.exists(MANIFEST_PATH):
+        os.replace(MANIFEST_PATH, MANIFEST_PATH.replace(".json", ".applied.json"))
+
+# --- sharded, incremental processing ---
+# Every raw file belongs to a fixed shard (hash of its name), and each shard
+# is one compact JSONL file in SHARD_DIR with the MinHash signatures of its
+# chunks next to it. A run only rebuilds shards with a new, changed
+# (size / mtime) or deleted raw file, so re-runs after a small re-crawl touch
+# a handful of shards and skip every unchanged input. The shards are then
+# merged, without near-duplicates, into PROCESSED_DIR / "corpus.jsonl",
+# which is what the indexer reads.
+NUM_SHARDS = int(os.environ.get("RAG_PROCESSOR_SHARDS", "64"))
+STATE_PATH = BASE_DIR / "data" / "processed_state.json"
+SHARD_DIR = PROCESSED_DIR / "shards"
+CORPUS_PATH = PROCESSED_DIR / "corpus.jsonl"
+LAYOUT = 2      # bump when the shard / output layout changes (forces a full rebuild)
+RAW_EXTENSIONS = (".json", ".jsonl", ".ndjson", ".jsonlines")
+
+def shard_of(fn: str, num_shards: int = NUM_SHARDS) -> int:
+    return int(hashlib.sha1(fn.encode("utf-8")).hexdigest()[:8], 16) % num_shards
+
+def shard_name(shard: int) -> str:
+    return f"part-{shard:04d}.jsonl"
+
+def build_shard(shard: int, in_paths):
+    """
+    Process-pool task: write one shard and its MinHash signatures from its raw
+    files; returns {raw file name: chunk count}.
+    """
+    out_path = os.path.join(SHARD_DIR, shard_name(shard))
+    tmp_path = out_path + ".tmp"
+    counts = {}
+    shard_entries = []
+    with open(tmp_path, "w", encoding="utf-8") as out_f:
+        for in_path in in_paths:
+            fn = os.path.basename(in_path)
+            try:
+                entries = process_items(in_path)
+            except Exception as e:
+                print(f"Failed processing {fn}: {e}")
+                entries = []
+            write_jsonl(entries, out_f)
+            counts[fn] = len(entries)
+            shard_entries.extend(entries)
+    if shard_entries:
+        save_signatures(out_path, shard_entries)
+        os.replace(tmp_path, out_path)
+    else:
+        os.remove(tmp_path)
+        for path in (out_path, sig_path(out_path)):
+            if os.path.exists(path):
+                os.remove(path)
+    return counts
+
+def load_state():
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    return len(all_processed)
+def save_state(state):
+    tmp_path = f"{STATE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_PATH)
 
-def process_all():
+def process_all(full=False, workers=None, num_shards=NUM_SHARDS, dedupe_threshold=DEDUPE_THRESHOLD):
+    """
+    Bring PROCESSED_DIR up to date with RAW_DIR on a pool of `workers`
+    processes. Only shards whose raw files changed are rebuilt, unless `full`.
+    Near-duplicate chunks across the whole corpus are then collapsed into one
+    (a `dedupe_threshold` above 1 disables this).
+    """
     ensure_dirs()
-    total = 0
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    start = time.perf_counter()
+    changes = load_manifest()
+    if changes:
+        statuses = [c["status"] for c in changes.values()]
+        print(f"Crawl manifest: {statuses.count('new')} new, {statuses.count('changed')} changed, "
+              f"{statuses.count('removed')} removed URLs")
+
+    state = load_state()
+    chunking = f"{tokenizer_name()}:{CHUNK_TOKENS}"
+    if state.get("shards") != num_shards or state.get("layout") != LAYOUT or state.get("chunking") != chunking:
+        full = True
+    previous = {} if full else state.get("files", {})
+
+    files = {}
     for fn in sorted(os.listdir(RAW_DIR)):
-        if not (fn.endswith(".json") or fn.endswith(".jsonl") or fn.endswith(".ndjson") or fn.endswith(".jsonlines")):
-            continue
-        in_path = os.path.join(RAW_DIR, fn)
-        out_path = os.path.join(PROCESSED_DIR, fn)
-        try:
-            count = process_file(in_path, out_path)
-            total += count
-            print(f"Processed {fn} -> {out_path} ({count} chunks)")
-        except Exception as e:
-            print(f"Failed processing {fn}: {e}")
-    print(f"Total processed chunks: {total}")
+        if fn.endswith(RAW_EXTENSIONS):
+            st = os.stat(os.path.join(RAW_DIR, fn))
+            files[fn] = [st.st_size, st.st_mtime_ns]
+
+    dirty = {shard_of(fn, num_shards) for fn, sig in files.items() if previous.get(fn, [None, None])[:2] != sig}
+    dirty |= {shard_of(fn, num_shards) for fn in previous if fn not in files}
+    members = {}
+    for fn in files:
+        members.setdefault(shard_of(fn, num_shards), []).append(os.path.join(RAW_DIR, fn))
+
+    if full:
+        # Outputs of older layouts (per raw file, shards in PROCESSED_DIR) or another shard count
+        for fn in os.listdir(PROCESSED_DIR):
+            if fn.endswith(RAW_EXTENSIONS) and fn != CORPUS_PATH.name:
+                os.remove(os.path.join(PROCESSED_DIR, fn))
+        keep = {shard_name(i) for i in range(num_shards)}
+        keep |= {os.path.basename(sig_path(fn)) for fn in keep}
+        for fn in os.listdir(SHARD_DIR):
+            if fn not in keep:
+                os.remove(os.path.join(SHARD_DIR, fn))
+        dirty = set(range(num_shards))
+
+    counts = {fn: sig[2] for fn, sig in previous.items() if len(sig) > 2}
+    skipped = sum(1 for fn in files if shard_of(fn, num_shards) not in dirty)
+    workers = workers or os.cpu_count() or 1
+    tasks = [(shard, members.get(shard, [])) for shard in sorted(dirty)]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(build_shard, [t[0] for t in tasks], [t[1] for t in tasks]))
+    else:
+        results = [build_shard(shard, paths) for shard, paths in tasks]
+    for shard_counts in results:
+        counts.update(shard_counts)
+
+    total = sum(counts.get(fn, 0) for fn in files)
+    print(f"Rebuilt {len(tasks)}/{num_shards} shards from {len(files) - skipped} raw files "
+          f"({skipped} unchanged skipped) in {time.perf_counter() - start:.1f}s; "
+          f"{total} processed chunks in total")
+
+    if tasks or not CORPUS_PATH.exists() or state.get("dedupe_threshold") != dedupe_threshold:
+        dedupe_start = time.perf_counter()
+        shard_paths = [os.path.join(SHARD_DIR, shard_name(i)) for i in range(num_shards)]
+        shard_paths = [p for p in shard_paths if os.path.exists(p)]
+        n_in, n_out, clusters = dedupe_corpus(shard_paths, str(CORPUS_PATH), dedupe_threshold)
+        removed = n_in - n_out
+        print(f"Dedupe: {n_in} -> {n_out} chunks (-{removed}, {100 * removed / max(n_in, 1):.1f}%) "
+              f"in {clusters} near-duplicate clusters, {time.perf_counter() - dedupe_start:.1f}s")
+
+    save_state({"layout": LAYOUT, "shards": num_shards, "chunking": chunking, "dedupe_threshold": dedupe_threshold,
+                "files": {fn: sig + [counts.get(fn, 0)] for fn, sig in files.items()}})
+    # Everything is up to date now, including whatever a pending manifest listed
+    consume_manifest()
 
 if __name__ == "__main__":
-    process_all()
+    import argparse
+    parser = argparse.ArgumentParser(description="Clean and chunk raw crawl output into JSONL shards")
+    parser.add_argument("--full", action="store_true",
+                        help="Rebuild every shard instead of only those with changed raw files")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Processes; 0 = one per core")
+    parser.add_argument("--shards", type=int, default=NUM_SHARDS,
+                        help="Number of output shards (changing it triggers a full rebuild)")
+    parser.add_argument("--dedupe-threshold", type=float, default=DEDUPE_THRESHOLD,
+                        help="Estimated Jaccard similarity above which chunks count as duplicates")
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help="Keep near-duplicate chunks (plain concatenation of the shards)")
+    args = parser.parse_args()
+    process_all(full=args.full, workers=args.workers or None, num_shards=args.shards,
+                dedupe_threshold=2.0 if args.no_dedupe else args.dedupe_threshold)
@@ -1,67 +1,280 @@
 import os
+import time
+import atexit
+import asyncio
+import threading
+from collections import Counter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
-from pymilvus import connections, Collection, utility
+
+try:
+    from .cache import EmbeddingCache, QUERY_CACHE_PATH, read_index_version
+    from .vector_store import open_store, VECTOR_BACKEND
+    from .encoder import get_encoder as load_encoder, encoder_key, ENCODER_BACKEND
+except ImportError:
+    from cache import EmbeddingCache, QUERY_CACHE_PATH, read_index_version
+    from vector_store import open_store, VECTOR_BACKEND
+    from encoder import get_encoder as load_encoder, encoder_key, ENCODER_BACKEND
 
 # --- CONFIG ---
 # Assuming this file is in backend/ directory
 BASE_DIR = Path(__file__).resolve().parent.parent
-DB_PATH = (BASE_DIR / "data" / "milvus.db").resolve()
-print("Using DB:", DB_PATH)
-COLLECTION_NAME = "lnmiit_rag"
 EMBED_MODEL = "all-MiniLM-L6-v2"
 
-# Load model once to avoid reloading on every request
-print("Loading Embedding Model...")
-model = SentenceTransformer(EMBED_MODEL)
+# Embedding + Milvus search are CPU-bound; they get their own small pool so
+# they never queue behind requests that are waiting on the LLM. Each encode
+# already uses several torch threads, so keep this close to the core count
+# divided by torch's intra-op threads rather than the number of requests.
+SEARCH_WORKERS = int(os.environ.get("RAG_SEARCH_WORKERS", "2"))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="rag-search")
+
+# Micro-batching of concurrent queries (see QueryBatcher); RAG_BATCH_MAX_SIZE=1 disables it
+BATCH_MAX_SIZE = int(os.environ.get("RAG_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("RAG_BATCH_MAX_WAIT_MS", "5"))
+
+# The encoder (torch or ONNX Runtime, see RAG_ENCODER_BACKEND) is loaded on
+# first use or by warmup() in the app lifespan, so importing this module stays
+# cheap for workers, CLIs and tests.
+_encoder = None
+_encoder_lock = threading.Lock()
+
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                print(f"Loading Embedding Model ({ENCODER_BACKEND})...")
+                start = time.perf_counter()
+                _encoder = load_encoder(EMBED_MODEL, backend=ENCODER_BACKEND)
+                print(f"Embedding model loaded in {time.perf_counter() - start:.2f}s")
+    return _encoder
+
+# Repeated queries skip the transformer forward pass entirely
+query_cache = EmbeddingCache(model_name=encoder_key(EMBED_MODEL, ENCODER_BACKEND))
+if QUERY_CACHE_PATH:
+    print(f"Loaded {query_cache.load(QUERY_CACHE_PATH)} cached query embeddings")
+    atexit.register(query_cache.save, QUERY_CACHE_PATH)
+
+# One open vector store (a loaded Milvus collection or the mmapped NumPy
+# store, see RAG_VECTOR_BACKEND) for the life of the process, instead of
+# has_collection / Collection() / load() on every request.
+_store = None
+_store_version = None
+_store_lock = threading.Lock()
+_ready = False
+
+def get_store():
+    """
+    Return the open vector store, or None if the index has not been built.
+    It is re-opened when the indexer publishes a new index version.
+    """
+    global _store, _store_version
+    version = read_index_version()
+    if _store is not None and version == _store_version:
+        return _store
 
-def connect_milvus():
-    """Helper to ensure connection exists"""
-    if not connections.has_connection("default"):
-        print(f"Connecting to Milvus: {DB_PATH}")
-        connections.connect("default", uri=str(DB_PATH))
+    with _store_lock:
+        if _store is None or version != _store_version:
+            store = open_store(VECTOR_BACKEND, encoder_key(EMBED_MODEL, ENCODER_BACKEND))
+            if store is None:
+                return None
+            _store, _store_version = store, version
+        return _store
+
+def warmup():
+    """
+    Load the encoder, open the vector store and run one embed + one search so
+    the first user request does not pay for lazy initialisation. The model is
+    loaded even without an index, so is_ready() can flip as soon as one is
+    built. Returns True when ready.
+    """
+    global _ready
+    # Straight to the model so the warm-up query does not land in the cache
+    vectors = get_encoder().encode(["LNMIIT warm-up query"])
+    store = get_store()
+    if store is None:
+        return False
+    store.search(vectors, 1)
+    _ready = True
+    return True
+
+def is_ready():
+    """
+    True once warm. If the index was missing at start-up, the store is opened
+    again here, so an index built later makes the process ready without a restart.
+    """
+    global _ready
+    if not _ready and _encoder is not None and get_store() is not None:
+        _ready = True
+    return _ready
+
+def embed_queries(queries):
+    """
+    Normalised (for Inner Product/Cosine match) float32 embeddings, one row per
+    query. Cached queries are reused; the rest go through a single forward pass.
+    """
+    vectors = [query_cache.get(q) for q in queries]
+    missing = list(dict.fromkeys(q for q, v in zip(queries, vectors) if v is None))
+    if missing:
+        emb = get_encoder().encode(missing)
+        fresh = dict(zip(missing, emb))
+        for q, e in fresh.items():
+            query_cache.put(q, e)
+        vectors = [fresh[q] if v is None else v for q, v in zip(queries, vectors)]
+    if not vectors:
+        return np.zeros((0, get_encoder().dim), dtype=np.float32)
+    return np.vstack(vectors)
+
+def embed_query(query):
+    return embed_queries([query])[0]
+
+def search_vectors(vectors, top_k=5):
+    """
+    Search with several query vectors at once; one result list per row.
+    Hits carry their stored vector as "embedding" (a NumPy array) so the
+    generator can pick diverse passages without re-encoding them; it is
+    dropped before hits are returned to clients.
+    """
+    store = get_store()
+    if store is None or len(vectors) == 0:
+        return [[] for _ in range(len(vectors))]
+    return store.search(vectors, top_k, with_vectors=True)
 
 def search(query, top_k=5):
-    connect_milvus()
-    
-    if not utility.has_collection(COLLECTION_NAME):
-        print(f"Collection {COLLECTION_NAME} not found.")
+    if get_store() is None:
         return []
+    return search_vectors(embed_queries([query]), top_k)[0]
+
+def search_many(queries, top_k=5, batch_size=64, with_embeddings=False):
+    """
+    Bulk version of `search`: embeds and searches `batch_size` queries per call.
+    With `with_embeddings`, returns (embedding, hits) per query instead, so
+    callers can reuse the query vectors (e.g. for the semantic answer cache).
+    """
+    if get_store() is None:
+        return [(None, []) if with_embeddings else [] for _ in queries]
+    results = []
+    for i in range(0, len(queries), batch_size):
+        batch = list(queries[i:i + batch_size])
+        vectors = embed_queries(batch)
+        hits = search_vectors(vectors, top_k)
+        results.extend(zip(vectors, hits) if with_embeddings else hits)
+    return results
+
+def _embed_and_search(queries, top_ks):
+    """
+    Batcher job: embed every query, then search only those with top_k > 0.
+    Returns (embedding, hits) per query; hits is None for embed-only entries.
+    """
+    vectors = embed_queries(queries)
+    wanted = [i for i, k in enumerate(top_ks) if k > 0]
+    hits = [None] * len(queries)
+    if wanted:
+        found = search_vectors(vectors[wanted], max(top_ks[i] for i in wanted))
+        for i, res in zip(wanted, found):
+            hits[i] = res[:top_ks[i]]
+    return list(zip(vectors, hits))
+
+class QueryBatcher:
+    """
+    Coalesces queries from concurrent requests: the first one opens a window of
+    `max_wait_ms`, everything arriving within it (up to `max_batch`) is encoded
+    in one forward pass and searched with one multi-vector store call.
+    """
+
+    def __init__(self, max_batch=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_sizes = Counter()
+        self._loop = None
+        self._queue = None
+        self._tasks = set()
+
+    def _start(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._spawn(self._collect())
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submit(self, query, top_k):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._start(loop)
+        fut = loop.create_future()
+        self._queue.put_nowait((query, top_k, fut))
+        return await fut
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes[len(batch)] += 1
+            # Keep collecting the next batch while this one runs on the pool
+            self._spawn(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        loop = asyncio.get_running_loop()
+        queries = [q for q, _, _ in batch]
+        top_ks = [k for _, k, _ in batch]
+        try:
+            results = await loop.run_in_executor(search_executor, _embed_and_search, queries, top_ks)
+        except Exception as e:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, _, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    def stats(self):
+        batches = sum(self.batch_sizes.values())
+        queries = sum(size * n for size, n in self.batch_sizes.items())
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": batches,
+            "queries": queries,
+            "mean_batch_size": round(queries / batches, 2) if batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+batcher = QueryBatcher()
+
+async def aembed_query(query):
+    if batcher.max_batch > 1:
+        embedding, _ = await batcher.submit(query, 0)
+        return embedding
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_executor, embed_query, query)
+
+async def asearch(query, top_k=5):
+    """Search without blocking the event loop, micro-batched with concurrent requests."""
+    if batcher.max_batch > 1:
+        _, hits = await batcher.submit(query, top_k)
+        return hits
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_executor, search, query, top_k)
 
-    collection = Collection(COLLECTION_NAME)
-    collection.load()  # Load into memory
-
-    # 1. Embed Query
-    q_emb = model.encode([query], convert_to_numpy=True)
-    
-    # 2. Normalize (for Inner Product/Cosine match)
-    norms = np.linalg.norm(q_emb, axis=1, keepdims=True)
-    q_emb = q_emb / (norms + 1e-10)
-
-    # 3. Search Milvus
-    search_params = {"metric_type": "IP", "params": {"level": 2}}
-    results = collection.search(
-        data=q_emb,
-        anns_field="embedding",
-        param=search_params,
-        limit=top_k,
-        output_fields=["content", "url", "title"]
-    )
-
-    # 4. Format results for the Generator
-    formatted_results = []
-    for hits in results:
-        for hit in hits:
-            formatted_results.append({
-                "score": float(hit.score),
-                "id": hit.id,
-                "title": hit.entity.get("title"),
-                "url": hit.entity.get("url"),
-                "content": hit.entity.get("content")
-            })
-            
-    return formatted_results
+async def asearch_many(queries, top_k=5, with_embeddings=False):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_executor, partial(search_many, queries, top_k,
+                                                               with_embeddings=with_embeddings))
 
 if __name__ == "__main__":
     # Test block
@@ -2,10 +2,14 @@
 """
 Polite site scraper for lnmiit.ac.in (updated)
 - Crawl same-domain HTML and PDF pages
-- Extract HTML text (trafilatura preferred)
+- Extract HTML text (trafilatura preferred) and links from a single lxml parse
 - Extract PDF text (pypdf)
 - Save chunked JSONL files under backend/data/raw/
 - Supports local PDF folder processing (--local-pdf-folder)
+- Conditional re-crawl (--refresh): ETag / Last-Modified / content hash,
+  one stable output file per URL and a manifest of new/changed/removed URLs
+- Concurrent fetching (--concurrency) with a per-host rate limit that
+  honours robots.txt Crawl-delay / Request-rate
 """
 
 import argparse
@@ -14,18 +18,32 @@ import json
 import os
 import re
 import time
-from collections import deque
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from urllib.parse import urljoin, urlparse, urlunparse
 import certifi
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 from dateutil import parser as dateparser
 from pypdf import PdfReader
 from tqdm import tqdm
 from urllib import robotparser
 import logging
 
+try:
+    from .crawl_state import CrawlState, STATE_PATH, QUEUED, FAILED, BLOCKED, GONE, update_manifest
+    from .chunker import chunk_text
+except ImportError:
+    from crawl_state import CrawlState, STATE_PATH, QUEUED, FAILED, BLOCKED, GONE, update_manifest
+    from chunker import chunk_text
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 try:
@@ -35,14 +53,15 @@ except Exception:
     _HAS_TRAFILATURA = False
 
 USER_AGENT = "lnmiit-ask-scraper/1.0 (+https://lnmiit.ac.in/)"
-DEFAULT_DELAY = 1.0
-CHUNK_SIZE_CHARS = 2000
-CHUNK_OVERLAP = 200
+DEFAULT_DELAY = 1.0          # minimum seconds between requests to one host
+DEFAULT_CONCURRENCY = 4
+MAX_PDF_BYTES = 50 * 1024 * 1024     # larger PDFs are not downloaded
+PDF_PAGES_PER_TASK = 8               # pages per process-pool task for PDF text extraction
 
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
 PDF_DIR = os.path.join(OUTPUT_DIR, "pdfs")
 RAW_DIR = os.path.join(OUTPUT_DIR, "raw")
-VISITED_PATH = os.path.join(OUTPUT_DIR, "visited.json")
+VISITED_PATH = os.path.join(OUTPUT_DIR, "visited.json")      # pre-SQLite state, imported once
 
 ALLOWED_SCHEMES = ("http", "https")
 
@@ -50,9 +69,27 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(PDF_DIR, exist_ok=True)
 os.makedirs(RAW_DIR, exist_ok=True)
 
-session = requests.Session()
-session.headers.update({"User-Agent": USER_AGENT})
-session.verify = certifi.where()
+# Pages are fetched with verify=False (see fetch_url)
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def make_session(pool_size=DEFAULT_CONCURRENCY):
+    """
+    Keep-alive session whose connection pool is large enough for `pool_size`
+    concurrent requests per host; retries connection errors and 429/5xx with backoff.
+    """
+    s = requests.Session()
+    s.headers.update({"User-Agent": USER_AGENT})
+    s.verify = certifi.where()
+    retry = Retry(total=2, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD"), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+session = make_session()
 
 os.environ.setdefault("SSL_CERT_FILE", certifi.where())
 
@@ -100,14 +137,80 @@ def allowed_by_robots(rp, url):
     return rp.can_fetch(USER_AGENT, url)
 
 
-def fetch_url(url, timeout=15):
-    try:
-        r = session.get(url, timeout=timeout, verify=False)
-        r.raise_for_status()
+def robots_interval(rp, delay):
+    """Seconds between requests to a host: our delay, or robots.txt's if it asks for more."""
+    if rp is None:
+        return delay
+    interval = delay
+    crawl_delay = rp.crawl_delay(USER_AGENT)
+    if crawl_delay:
+        interval = max(interval, float(crawl_delay))
+    rate = rp.request_rate(USER_AGENT)
+    if rate and rate.requests:
+        interval = max(interval, rate.seconds / rate.requests)
+    return interval
+
+
+class RobotsCache:
+    """robots.txt parser per host, fetched once on first use."""
 
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    def __init__(self):
+        self._parsers = {}
+        self._lock = threading.Lock()
 
+    def get(self, url):
+        p = urlparse(url)
+        key = (p.scheme, p.netloc)
+        with self._lock:
+            if key not in self._parsers:
+                self._parsers[key] = get_robots_parser(url)
+            return self._parsers[key]
+
+
+class HostRateLimiter:
+    """
+    Token bucket per host: up to `burst` requests back to back, then one every
+    `interval` seconds (per-host overrides via set_interval, e.g. Crawl-delay).
+    acquire() blocks the calling thread until the host has a token, or
+    returns False early if `stop` (a threading.Event) gets set.
+    """
+
+    def __init__(self, interval=DEFAULT_DELAY, burst=1):
+        self.interval = interval
+        self.burst = max(1, burst)
+        self._intervals = {}
+        self._buckets = {}      # host -> (tokens, last refill)
+        self._lock = threading.Lock()
+
+    def set_interval(self, host, interval):
+        with self._lock:
+            self._intervals[host] = interval
+
+    def acquire(self, host, stop=None):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                interval = self._intervals.get(host, self.interval)
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                if interval > 0:
+                    tokens = min(self.burst, tokens + (now - last) / interval)
+                else:
+                    tokens = self.burst
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return True
+                self._buckets[host] = (tokens, now)
+                wait_s = (1 - tokens) * interval
+            if stop is None:
+                time.sleep(wait_s)
+            elif stop.wait(wait_s):
+                return False
+
+
+def fetch_url(url, timeout=15, http=None, stream=False):
+    try:
+        r = (http or session).get(url, timeout=timeout, verify=False, stream=stream)
+        r.raise_for_status()
         return r
     except Exception as e:
         logging.warning(f"[fetch] Error fetching {url}: {e}")
@@ -154,62 +257,179 @@ def find_links(html, base_url):
 
 
 
+_DROP_TAGS = ("script", "style", "nav", "footer", "header", "noscript", "svg")
+_TEXT_TAGS = ("h1", "h2", "h3", "h4", "p", "li")
+
+
+def parse_html(html):
+    """lxml tree of a page, or None if it does not parse."""
+    try:
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # str input with an XML encoding declaration
+            return lxml.html.document_fromstring(html.encode("utf-8"))
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def links_from_tree(tree, base_url):
+    """Same rules as find_links, on an already parsed tree."""
+    links = set()
+    for href in tree.xpath("//a/@href"):
+        href = href.strip()
+        if href.startswith("mailto:") or href.startswith("tel:"):
+            continue
+        joined = urljoin(base_url, href)
+        p = urlparse(joined)
+        if p.scheme not in ALLOWED_SCHEMES:
+            continue
+        links.add(p._replace(fragment="").geturl())
+    return links
+
+
+def text_from_tree(tree, url):
+    """Same as extract_text_from_html, on an already parsed tree (which it modifies)."""
+    if _HAS_TRAFILATURA:
+        try:
+            # trafilatura copies a tree it is given instead of parsing again
+            text = trafilatura.extract(tree, url=url)
+            if text and text.strip():
+                return text.strip()
+        except Exception:
+            pass
+
+    for el in [el for el in tree.iter(*_DROP_TAGS)]:
+        if el.getparent() is not None:
+            el.drop_tree()
+
+    parts = []
+    for el in tree.iter(*_TEXT_TAGS):
+        text = " ".join(t.strip() for t in el.itertext() if t.strip())
+        if text:
+            parts.append(text)
+
+    return "\n\n".join(parts).strip()
+
+
+def extract_html(html, url):
+    """
+    (text, links) of a page from one lxml parse. Runs in the extraction
+    process pool during a crawl; replaces extract_text_from_html + find_links,
+    which parse the page separately (and are kept for other callers and
+    the --bench-extract comparison).
+    """
+    tree = parse_html(html)
+    if tree is None:
+        return "", set()
+    links = links_from_tree(tree, url)
+    return text_from_tree(tree, url), links
+
+
 def is_pdf_link(url):
     return url.lower().split("?")[0].endswith(".pdf")
 
 
-def download_pdf(url, out_dir=PDF_DIR):
+def save_response(r, path, max_bytes=MAX_PDF_BYTES):
+    """
+    Stream a (stream=True) response body to `path` without holding it in memory.
+    Returns False, leaving nothing behind, if it is larger than `max_bytes`.
+    """
+    length = r.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > max_bytes:
+        logging.warning(f"[pdf] Skipping {r.url}: {int(length)} bytes is over the {max_bytes} byte limit")
+        return False
+    tmp_path = path + ".part"
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for block in r.iter_content(chunk_size=64 * 1024):
+                size += len(block)
+                if size > max_bytes:
+                    raise ValueError(f"over the {max_bytes} byte limit")
+                f.write(block)
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        logging.warning(f"[pdf] Failed to save {r.url}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def pdf_path_for(url, out_dir=PDF_DIR):
     os.makedirs(out_dir, exist_ok=True)
-    safe_name = url_hash(url) + ".pdf"
-    local_name = os.path.join(out_dir, safe_name)
+    return os.path.join(out_dir, url_hash(url) + ".pdf")
 
-    if os.path.exists(local_name):
+
+def download_pdf(url, out_dir=PDF_DIR, overwrite=False, max_bytes=MAX_PDF_BYTES):
+    local_name = pdf_path_for(url, out_dir)
+
+    if os.path.exists(local_name) and not overwrite:
         return local_name
 
-    r = fetch_url(url)
+    r = fetch_url(url, stream=True)
     if r is None:
         return None
+    with r:
+        return local_name if save_response(r, local_name, max_bytes) else None
 
-    try:
-        with open(local_name, "wb") as f:
-            f.write(r.content)
-        return local_name
-    except Exception as e:
-        logging.warning(f"[pdf] Failed to save {url}: {e}")
-        return None
+
+def _pdf_page_texts(path, start, end):
+    """Process-pool task: text of pages [start, end)."""
+    reader = PdfReader(path)
+    texts = []
+    for i in range(start, end):
+        try:
+            texts.append(reader.pages[i].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
 
 
-def extract_text_from_pdf(local_pdf_path):
+def _ocr_page_texts(path, start, end):
+    """Process-pool task: OCR pages [start, end), rendering one page at a time."""
+    from pdf2image import convert_from_path
+    import pytesseract
+
+    texts = []
+    for n in range(start + 1, end + 1):     # pdf2image counts pages from 1
+        images = convert_from_path(path, first_page=n, last_page=n)
+        texts.append("\n".join(pytesseract.image_to_string(im) for im in images))
+        del images
+    return texts
+
+
+def _map_pages(task, path, n_pages, pool=None):
+    """Run `task` over ranges of PDF_PAGES_PER_TASK pages, on `pool` if given; texts in page order."""
+    ranges = [(s, min(s + PDF_PAGES_PER_TASK, n_pages)) for s in range(0, n_pages, PDF_PAGES_PER_TASK)]
+    if pool is None or len(ranges) < 2:
+        results = (task(path, s, e) for s, e in ranges)
+    else:
+        results = pool.map(task, [path] * len(ranges), [s for s, _ in ranges], [e for _, e in ranges])
+    return [text for texts in results for text in texts]
+
+
+def make_extract_pool(workers=None):
+    """Processes for HTML parsing and PDF text extraction / OCR (spawned: the crawler is multi-threaded)."""
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=mp.get_context("spawn"))
+
+
+def extract_text_from_pdf(local_pdf_path, pool=None):
     """
     Extract text from PDF using normal extraction first.
     If no text found (scanned PDF), fallback to OCR.
+    With a `pool` (see make_extract_pool) page ranges are extracted in parallel;
+    OCR renders a single page at a time, so memory does not grow with page count.
     """
     try:
-        # Try normal extraction
-        reader = PdfReader(local_pdf_path)
-        texts = []
-        for page in reader.pages:
-            try:
-                text = page.extract_text() or ""
-                texts.append(text)
-            except Exception:
-                continue
-
-        extracted = "\n\n".join(texts).strip()
+        n_pages = len(PdfReader(local_pdf_path).pages)
+        extracted = "\n\n".join(_map_pages(_pdf_page_texts, local_pdf_path, n_pages, pool)).strip()
 
         # If extracted text is empty, run OCR
-        if not extracted:
-            logging.info(f"OCR fallback triggered for: {local_pdf_path}")
-            from pdf2image import convert_from_path
-            import pytesseract
-
-            pages = convert_from_path(local_pdf_path)
-            ocr_texts = []
-            for i, pg in enumerate(pages):
-                logging.info(f"OCR on page {i+1}/{len(pages)}")
-                ocr_texts.append(pytesseract.image_to_string(pg))
-
-            extracted = "\n\n".join(ocr_texts).strip()
+        if not extracted and n_pages:
+            logging.info(f"OCR fallback triggered for: {local_pdf_path} ({n_pages} pages)")
+            extracted = "\n\n".join(_map_pages(_ocr_page_texts, local_pdf_path, n_pages, pool)).strip()
 
         return extracted
 
@@ -218,38 +438,16 @@ def extract_text_from_pdf(local_pdf_path):
         return ""
 
 
-
-
-
-def chunk_text(text, chunk_size=CHUNK_SIZE_CHARS, overlap=CHUNK_OVERLAP):
-    if not text:
-        return []
-
-    text = text.replace("\r\n", "\n").strip()
-    chunks = []
-    start = 0
-    L = len(text)
-
-    while start < L:
-        end = start + chunk_size
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-
-        start = end - overlap
-        if start < 0:
-            start = 0
-
-    return chunks
+def raw_path(url):
+    """One file per URL, replaced in place when the page changes."""
+    return os.path.join(RAW_DIR, f"{url_hash(url)}.jsonl")
 
 
 def write_chunks_jsonl(chunks, metadata):
-    url = metadata.get("url", "")
-    fname_base = url_hash(url)
-    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    filename = os.path.join(RAW_DIR, f"{fname_base}_{ts}.jsonl")
+    filename = raw_path(metadata.get("url", ""))
+    tmp_name = filename + ".tmp"
 
-    with open(filename, "w", encoding="utf-8") as fh:
+    with open(tmp_name, "w", encoding="utf-8") as fh:
         for i, chunk in enumerate(chunks):
             record = {
                 "id": f"{metadata.get('url','')}_chunk_{i}",
@@ -257,10 +455,12 @@ def write_chunks_jsonl(chunks, metadata):
                 "meta": {**metadata, "chunk_index": i}
             }
             fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_name, filename)
     return filename
 
-def process_local_pdfs(folder_path):
+def process_local_pdfs(folder_path, workers=None):
     logging.info(f"Scanning local folder: {folder_path}")
+    pool = make_extract_pool(workers)
 
     for fname in os.listdir(folder_path):
         if not fname.lower().endswith(".pdf"):
@@ -270,7 +470,7 @@ def process_local_pdfs(folder_path):
         logging.info(f"\n=== Processing PDF: {fname} ===")
         logging.info(f"Path: {pdf_path}")
 
-        text = extract_text_from_pdf(pdf_path)
+        text = extract_text_from_pdf(pdf_path, pool)
 
         if not text:
             logging.warning("No text extracted from this PDF.")
@@ -298,130 +498,312 @@ def process_local_pdfs(folder_path):
         out_path = write_chunks_jsonl(chunks, metadata)
         logging.info(f"Saved JSONL: {out_path}")
 
+    pool.shutdown()
 
-def load_visited():
-    try:
-        if os.path.exists(VISITED_PATH):
-            with open(VISITED_PATH, "r", encoding="utf-8") as fh:
-                data = json.load(fh)
-                return set(data.get("visited", []))
-    except Exception:
-        pass
-    return set()
 
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
-def save_visited(visited_set):
-    try:
-        with open(VISITED_PATH, "w", encoding="utf-8") as fh:
-            json.dump({"visited": list(visited_set)}, fh, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
 
+def conditional_headers(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def fetch_page(url, rp, limiter, http, stop=None, etag=None, last_modified=None, timeout=15,
+               extract_pool=None, max_pdf_bytes=MAX_PDF_BYTES, save_html_dir=None):
+    """
+    Worker: wait for the host's rate limit, fetch (conditionally, when we have
+    validators from an earlier crawl), and extract text and links, so other
+    workers' network I/O overlaps parsing. Each URL is requested once: PDF
+    bodies are streamed straight to disk, and PDFs and HTML are both handed to
+    `extract_pool` so parsing runs outside this process. With `save_html_dir`
+    the HTML is also saved there (e.g. as fixtures for --bench-extract).
+    Returns a dict with "kind" in {"blocked", "stopped", "failed", "gone",
+    "not_modified", "pdf", "html"}.
+    """
+    if not allowed_by_robots(rp, url):
+        return {"kind": "blocked"}
 
-def crawl(seed_url, max_pages=200, max_depth=3, delay=DEFAULT_DELAY, verbose=True, resume=True):
+    if not limiter.acquire(urlparse(url).netloc, stop):
+        return {"kind": "stopped"}
+    try:
+        r = http.get(url, timeout=timeout, verify=False, headers=conditional_headers(etag, last_modified), stream=True)
+    except Exception as e:
+        logging.warning(f"[fetch] Error fetching {url}: {e}")
+        return {"kind": "failed", "error": str(e)}
+    with r:
+        if r.status_code == 304:
+            return {"kind": "not_modified", "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        if r.status_code in (404, 410):
+            return {"kind": "gone"}
+        if r.status_code >= 400:
+            logging.warning(f"[fetch] Error fetching {url}: HTTP {r.status_code}")
+            return {"kind": "failed", "error": f"HTTP {r.status_code}"}
+        validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+        content_type = r.headers.get("Content-Type", "")
+        is_pdf = is_pdf_link(url) or "application/pdf" in content_type.lower()
+        if is_pdf:
+            local_pdf = pdf_path_for(url)
+            if not save_response(r, local_pdf, max_pdf_bytes):
+                return {"kind": "failed", "error": "PDF download failed or over the size limit"}
+        else:
+            html = r.text
+
+    if is_pdf:
+        # The connection is back in the pool while the pages are extracted
+        text = extract_text_from_pdf(local_pdf, extract_pool)
+        return {"kind": "pdf", "text": text, "title": os.path.basename(local_pdf), "links": set(), **validators}
+
+    if save_html_dir:
+        with open(os.path.join(save_html_dir, url_hash(url) + ".html"), "w", encoding="utf-8") as fh:
+            fh.write(f"<!-- {url} -->\n{html}")
+    if extract_pool is not None:
+        text, links = extract_pool.submit(extract_html, html, url).result()
+    else:
+        text, links = extract_html(html, url)
+    return {"kind": "html", "text": text, "title": "", "links": links, **validators}
+
+
+def crawl(seed_url, max_pages=200, max_depth=3, delay=DEFAULT_DELAY, verbose=True, resume=True,
+          concurrency=DEFAULT_CONCURRENCY, burst=1, state_path=STATE_PATH, retry_failed=False, refresh=False,
+          extract_workers=None, max_pdf_bytes=MAX_PDF_BYTES, save_html_dir=None):
+    """
+    Breadth-first crawl with `concurrency` fetch workers. Requests to each host
+    are spaced by `delay` seconds (or robots.txt Crawl-delay, if larger) with
+    bursts of up to `burst`, so one host never gets more than `burst` requests
+    per `delay` however large `concurrency` is: workers overlap latency within
+    that budget. Files and the crawl state are only written from this thread. The frontier and visited/failed URLs live in a CrawlState
+    database, so with `resume` an interrupted crawl picks up its queue again.
+
+    `refresh` re-visits every known URL with conditional requests: pages that
+    answer 304 or whose text hashes the same are left alone, and only new,
+    changed and removed URLs are written to the change manifest.
+    Pages are parsed (and PDFs, up to `max_pdf_bytes`, extracted) on a pool of
+    `extract_workers` processes (default: one per core).
+    Returns the raw files written (new or changed pages).
+    """
     seed_url = sanitize_url(seed_url)
     parsed_seed = urlparse(seed_url)
     seed_netloc = parsed_seed.netloc
 
-    rp = get_robots_parser(seed_url)
-    visited = load_visited() if resume else set()
+    robots = RobotsCache()
+    limiter = HostRateLimiter(delay, burst)
+    http = make_session(concurrency)
+    if save_html_dir:
+        os.makedirs(save_html_dir, exist_ok=True)
+    extract_pool = make_extract_pool(extract_workers)
+    stop = threading.Event()
+
+    state = CrawlState(state_path)
+    if not resume:
+        state.reset()
+    state.import_visited_json(VISITED_PATH)
+    if refresh:
+        state.begin_refresh(max_depth)
+    if retry_failed:
+        logging.info(f"Re-queued {state.retry_failed()} failed URLs")
+    state.enqueue(normalize_url_for_dedupe(seed_url), seed_url, 0, priority=1)
 
-    q = deque()
-    q.append((seed_url, 0))
     pages_crawled = 0
     out_files = []
+    events = []             # (url, "new" | "changed" | "removed", raw file name)
+    unchanged = 0
 
     pbar = tqdm(total=max_pages, desc="Crawling", unit="page") if verbose else None
 
-    while q and pages_crawled < max_pages:
-        url, depth = q.popleft()
-        normalized = normalize_url_for_dedupe(url)
-
-        if normalized in visited:
-            continue
-        if depth > max_depth:
-            continue
-        if not allowed_by_robots(rp, url):
-            visited.add(normalized)
-            save_visited(visited)
-            continue
-
-        time.sleep(delay)
-
-        r = fetch_url(url)
-        if r is None:
-            visited.add(normalized)
-            save_visited(visited)
-            continue
-
-        content_type = r.headers.get("Content-Type", "")
+    def submit(pool, pending):
+        free = concurrency - len(pending)
+        if free <= 0:
+            return
+        for key, url, depth in state.pop(free, max_depth=max_depth):
+            rp = robots.get(url)
+            limiter.set_interval(urlparse(url).netloc, robots_interval(rp, delay))
+            etag, last_modified, old_hash, old_file = state.validators(key)
+            # Without the old output a 304 would leave nothing to keep
+            if not old_file:
+                etag = last_modified = None
+            pending[pool.submit(fetch_page, url, rp, limiter, http, stop, etag, last_modified,
+                                   extract_pool=extract_pool, max_pdf_bytes=max_pdf_bytes,
+                                   save_html_dir=save_html_dir)] = \
+                (key, url, depth, old_hash, old_file)
+
+    def remove(key, url, old_file):
+        if old_file and os.path.exists(os.path.join(RAW_DIR, old_file)):
+            os.remove(os.path.join(RAW_DIR, old_file))
+        state.drop_output(key)
+        events.append((url, "removed", old_file))
 
-        # PDF
-        if is_pdf_link(url) or "application/pdf" in content_type.lower():
-            local_pdf = download_pdf(url)
-            if local_pdf:
-                text = extract_text_from_pdf(local_pdf)
-                if text:
-                    metadata = {
-                        "url": url,
-                        "title": os.path.basename(local_pdf),
-                        "fetched_at": datetime.utcnow().isoformat(),
-                        "type": "pdf"
-                    }
-                    chunks = chunk_text(text)
-                    if chunks:
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="crawl") as pool:
+            pending = {}
+            submit(pool, pending)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    key, url, depth, old_hash, old_file = pending.pop(fut)
+                    try:
+                        page = fut.result()
+                    except Exception as e:
+                        logging.warning(f"[crawl] Error processing {url}: {e}")
+                        page = {"kind": "failed", "error": str(e)}
+
+                    kind = page["kind"]
+                    if kind in ("blocked", "gone"):
+                        state.mark(key, BLOCKED if kind == "blocked" else GONE)
+                        if old_file:
+                            remove(key, url, old_file)
+                        continue
+                    if kind == "failed":
+                        state.mark(key, FAILED, page.get("error"))
+                        continue
+                    if kind == "stopped" or pages_crawled >= max_pages:
+                        # Not fetched, or fetched past the page budget: leave it for a resumed crawl
+                        state.mark(key, QUEUED)
+                        continue
+                    if kind == "not_modified":
+                        state.record_fetch(key, page.get("etag"), page.get("last_modified"), keep=True)
+                        unchanged += 1
+                        pages_crawled += 1
+                        if pbar:
+                            pbar.update(1)
+                        continue
+
+                    text = page["text"]
+                    chunks = chunk_text(text) if text else []
+                    new_hash = text_hash(text) if chunks else None
+                    if new_hash is not None and new_hash == old_hash:
+                        state.record_fetch(key, page.get("etag"), page.get("last_modified"), keep=True)
+                        unchanged += 1
+                    elif chunks:
+                        metadata = {
+                            "url": url,
+                            "title": page["title"],
+                            "fetched_at": datetime.utcnow().isoformat(),
+                            "type": kind
+                        }
                         fname = write_chunks_jsonl(chunks, metadata)
                         out_files.append(fname)
+                        events.append((url, "changed" if old_file else "new", os.path.basename(fname)))
+                        state.record_fetch(key, page.get("etag"), page.get("last_modified"), new_hash,
+                                           os.path.basename(fname))
+                    else:
+                        # No usable text any more
+                        state.record_fetch(key, page.get("etag"), page.get("last_modified"))
+                        if old_file:
+                            remove(key, url, old_file)
+                    if chunks:
                         pages_crawled += 1
                         if pbar:
                             pbar.update(1)
 
-            visited.add(normalized)
-            save_visited(visited)
-            continue
-
-        # HTML
-        html = r.text
-        text = extract_text_from_html(html, url)
-        if text:
-            metadata = {
-                "url": url,
-                "title": "",
-                "fetched_at": datetime.utcnow().isoformat(),
-                "type": "html"
-            }
-            chunks = chunk_text(text)
-            if chunks:
-                fname = write_chunks_jsonl(chunks, metadata)
-                out_files.append(fname)
-                pages_crawled += 1
-                if pbar:
-                    pbar.update(1)
-
-        # Add links
-        links = find_links(html, url)
-        for link in links:
-            if is_same_domain(seed_netloc, link):
-                n = normalize_url_for_dedupe(link)
-                if n not in visited:
-                    q.append((link, depth + 1))
-
-        visited.add(normalized)
-        save_visited(visited)
-
-    if pbar:
-        pbar.close()
+                    if depth < max_depth:
+                        state.enqueue_many((normalize_url_for_dedupe(link), link, depth + 1, 0)
+                                           for link in page.get("links", ()) if is_same_domain(seed_netloc, link))
+
+                if pages_crawled < max_pages:
+                    submit(pool, pending)
+                else:
+                    # Enough pages: drop fetches still waiting to start or on the rate limit
+                    stop.set()
+                    for fut in [f for f in pending if f.cancel()]:
+                        state.mark(pending.pop(fut)[0], QUEUED)
+
+        if not stop.is_set() and not state.has_queued():
+            # The whole site was walked: pages with output that were not reached
+            # this time are no longer linked from it. Queued URLs (e.g. left
+            # below a smaller --max-depth) mean the walk is not complete yet.
+            for key, url, old_file in state.stale_outputs():
+                remove(key, url, old_file)
+    finally:
+        # Anything still marked in flight after a crash is re-queued on the next open
+        if events:
+            update_manifest(events)
+        counts = {status: sum(1 for e in events if e[1] == status) for status in ("new", "changed", "removed")}
+        logging.info(f"Changes: {counts}, {unchanged} unchanged. Crawl state: {state.counts()}")
+        state.close()
+        extract_pool.shutdown(cancel_futures=True)
+        if pbar:
+            pbar.close()
 
     return out_files
 
+def bench_extract(fixture_dir, workers=None):
+    """
+    Pages/sec over saved pages (*.html, e.g. from --save-html): the old
+    extract_text_from_html + find_links path, single-parse extract_html, and
+    extract_html on the process pool.
+    """
+    pages = []
+    for fname in sorted(os.listdir(fixture_dir)):
+        if fname.endswith((".html", ".htm")):
+            with open(os.path.join(fixture_dir, fname), "r", encoding="utf-8", errors="replace") as fh:
+                html = fh.read()
+            m = re.match(r"<!-- (\S+) -->", html)
+            pages.append((html, m.group(1) if m else f"https://lnmiit.ac.in/{fname}"))
+    if not pages:
+        print(f"No .html files in {fixture_dir}. Save some with e.g.\n"
+              f"  python backend/rag/scraper.py --seed https://lnmiit.ac.in --max-pages 150 "
+              f"--state /tmp/bench_state.sqlite3 --save-html {fixture_dir}")
+        return
+
+    def report(name, seconds):
+        print(f"{name:<28} {len(pages) / seconds:>8.1f} pages/sec")
+
+    start = time.perf_counter()
+    old = [(extract_text_from_html(html, url), find_links(html, url)) for html, url in pages]
+    report("two parses (old)", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    new = [extract_html(html, url) for html, url in pages]
+    report("single parse", time.perf_counter() - start)
+
+    workers = workers or os.cpu_count() or 1
+    with make_extract_pool(workers) as pool:
+        # Start (spawn) every worker before timing
+        list(pool.map(extract_html, ["<p>warm-up</p>"] * workers, ["https://lnmiit.ac.in/"] * workers))
+        start = time.perf_counter()
+        list(pool.map(extract_html, [h for h, _ in pages], [u for _, u in pages], chunksize=4))
+        report(f"single parse, {workers} processes", time.perf_counter() - start)
+
+    same_links = sum(o[1] == n[1] for o, n in zip(old, new))
+    same_text = sum(o[0] == n[0] for o, n in zip(old, new))
+    print(f"{len(pages)} pages: identical links on {same_links}, identical text on {same_text}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Polite site scraper")
     parser.add_argument("--seed", help="Seed URL for crawling")
     parser.add_argument("--local-pdf-folder", help="Path to folder containing local PDFs")
     parser.add_argument("--max-pages", type=int, default=200)
     parser.add_argument("--max-depth", type=int, default=3)
-    parser.add_argument("--delay", type=float, default=DEFAULT_DELAY)
-    parser.add_argument("--no-resume", action="store_true")
+    parser.add_argument("--delay", type=float, default=DEFAULT_DELAY,
+                        help="Minimum seconds between requests to the same host (robots.txt Crawl-delay wins if larger)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Parallel fetch/extract workers; per-host throughput is still capped by --delay and --burst")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="Requests a host may receive back to back before --delay applies")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Start from the seed with an empty crawl state instead of resuming")
+    parser.add_argument("--extract-workers", "--pdf-workers", type=int, default=None,
+                        help="Processes for HTML parsing, PDF text extraction and OCR (default: one per core)")
+    parser.add_argument("--save-html", metavar="DIR",
+                        help="Also save every fetched HTML page to DIR (fixtures for --bench-extract)")
+    parser.add_argument("--bench-extract", metavar="DIR",
+                        help="Compare single-parse extraction with the old two-parse path on saved *.html pages")
+    parser.add_argument("--max-pdf-mb", type=float, default=MAX_PDF_BYTES / (1024 * 1024),
+                        help="Skip PDFs larger than this")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Re-check every known URL (conditional GET) and record only what changed")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Queue URLs that failed in earlier runs again (up to 3 attempts)")
+    parser.add_argument("--state", default=STATE_PATH,
+                        help="Crawl state database (a separate one re-fetches everything, e.g. for --save-html)")
     args = parser.parse_args()
 
     logging.info("Trafilatura available: %s", _HAS_TRAFILATURA)
@@ -429,10 +811,14 @@ if __name__ == "__main__":
     # Local PDF mode
     if args.local_pdf_folder:
         logging.info(f"Processing local PDFs in folder: {args.local_pdf_folder}")
-        process_local_pdfs(args.local_pdf_folder)
+        process_local_pdfs(args.local_pdf_folder, args.extract_workers)
         logging.info("Completed local PDF processing.")
         exit(0)
 
+    if args.bench_extract:
+        bench_extract(args.bench_extract, args.extract_workers)
+        exit(0)
+
     # If not local mode, seed is required
     if not args.seed:
         parser.error("--seed is required unless you use --local-pdf-folder")
@@ -445,6 +831,14 @@ if __name__ == "__main__":
         delay=args.delay,
         verbose=True,
         resume=not args.no_resume,
+        concurrency=args.concurrency,
+        burst=args.burst,
+        retry_failed=args.retry_failed,
+        refresh=args.refresh,
+        extract_workers=args.extract_workers,
+        state_path=args.state,
+        save_html_dir=args.save_html,
+        max_pdf_bytes=int(args.max_pdf_mb * 1024 * 1024),
     )
 
     logging.info("Wrote %d files to %s", len(out), OUTPUT_DIR)
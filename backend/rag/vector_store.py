@@ -0,0 +1,377 @@
+# vector_store.py  (vector search backends behind retriever.search)
+
+import os, json, mmap, shutil, time
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent          # backend/
+DB_PATH = (BASE_DIR / "data" / "milvus.db").resolve()
+NUMPY_STORE_DIR = BASE_DIR / "data" / "numpy_store"
+COLLECTION_NAME = "lnmiit_rag"
+SEARCH_PARAMS = {"metric_type": "IP", "params": {"level": 2}}
+OUTPUT_FIELDS = ["content", "url", "title", "aliases"]
+
+# "milvus" (Milvus Lite) or "numpy" (memory-mapped exact search, no server, no lock file)
+VECTOR_BACKEND = os.environ.get("RAG_VECTOR_BACKEND", "milvus")
+# For quantised NumPy stores: candidates taken from the coarse search per
+# requested result, re-scored exactly against the float vectors
+RESCORE_FACTOR = int(os.environ.get("RAG_RESCORE_FACTOR", "10"))
+QUANTIZATIONS = ("none", "int8", "binary")
+_BLOCK_ROWS = 16384
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def connect_milvus():
+    """Helper to ensure connection exists"""
+    from pymilvus import connections
+    if not connections.has_connection("default"):
+        print(f"Connecting to Milvus: {DB_PATH}")
+        connections.connect("default", uri=str(DB_PATH))
+
+
+class MilvusStore:
+    """Loaded Milvus collection; search() takes a (n, dim) matrix of query vectors."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        # Collections indexed before dedupe aliases have no "aliases" field,
+        # and asking for a missing output field fails every search
+        fields = {f.name for f in collection.schema.fields}
+        self.output_fields = [f for f in OUTPUT_FIELDS if f in fields]
+
+    @classmethod
+    def open(cls):
+        from pymilvus import Collection, utility
+        connect_milvus()
+        if not utility.has_collection(COLLECTION_NAME):
+            print(f"Collection {COLLECTION_NAME} not found.")
+            return None
+        collection = Collection(COLLECTION_NAME)
+        collection.load()  # Load into memory
+        return cls(collection)
+
+    def search(self, vectors, top_k=5, with_vectors=False):
+        results = self.collection.search(
+            data=vectors,
+            anns_field="embedding",
+            param=SEARCH_PARAMS,
+            limit=top_k,
+            output_fields=self.output_fields + (["embedding"] if with_vectors else [])
+        )
+        with_aliases = "aliases" in self.output_fields
+        out = []
+        for hits in results:
+            rows = []
+            for hit in hits:
+                row = {
+                    "score": float(hit.score),
+                    "id": hit.id,
+                    "title": hit.entity.get("title"),
+                    "url": hit.entity.get("url"),
+                    "content": hit.entity.get("content"),
+                    "aliases": json.loads(hit.entity.get("aliases") or "[]") if with_aliases else []
+                }
+                if with_vectors:
+                    row["embedding"] = np.asarray(hit.entity.get("embedding"), dtype=np.float32)
+                rows.append(row)
+            out.append(rows)
+        return out
+
+
+class NumpyStore:
+    """
+    Exact inner-product search over a memory-mapped float32 matrix.
+
+    Layout of NUMPY_STORE_DIR (written by NumpyStoreWriter):
+      embeddings.npy  (n, dim) float32, normalised
+      docs.jsonl      one {"id", "url", "title", "content"[, "aliases"]} record per row
+      offsets.npy     (n + 1,) int64 byte offsets of each row in docs.jsonl
+      manifest.json   {"count", "dim", "model", "quantization", "int8_scale"}
+      embeddings.int8.npy / embeddings.bin.npy   optional quantised copy
+
+    Everything is opened read-only through mmap, so all uvicorn workers share
+    the same page-cache copy. With a quantised copy, each query scans only the
+    compact codes (4x smaller for int8, 32x for binary) and reads the float
+    rows of RESCORE_FACTOR * top_k candidates to re-score them exactly. The
+    float matrix is always required (re-scoring, hit vectors, exact=True), so
+    quantisation bounds the bytes scanned per query, not the store's size.
+    """
+
+    def __init__(self, path=NUMPY_STORE_DIR, model=None):
+        path = Path(path)
+        with open(path / "manifest.json", "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        # Query vectors from another model (or encoder backend) would still
+        # "work" and return quietly wrong results
+        if model is not None and self.manifest.get("model") != model:
+            raise ValueError(f"NumPy vector store at {path} was built with encoder {self.manifest.get('model')!r}, "
+                             f"but queries are encoded with {model!r}; re-run the indexer or set "
+                             f"RAG_ENCODER_BACKEND to match")
+        self.vectors = np.load(path / "embeddings.npy", mmap_mode="r")
+        self.quantization = self.manifest.get("quantization", "none")
+        self.codes = None
+        if self.quantization == "int8":
+            self.codes = np.load(path / "embeddings.int8.npy", mmap_mode="r")
+        elif self.quantization == "binary":
+            self.codes = np.load(path / "embeddings.bin.npy", mmap_mode="r")
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        with open(path / "docs.jsonl", "rb") as f:
+            self._docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b""
+
+    @classmethod
+    def open(cls, path=NUMPY_STORE_DIR, model=None):
+        if not (Path(path) / "manifest.json").exists():
+            print(f"NumPy vector store not found at {path}.")
+            return None
+        return cls(path, model)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def doc(self, row):
+        return json.loads(self._docs[int(self.offsets[row]):int(self.offsets[row + 1])])
+
+    @staticmethod
+    def _select(scores, k):
+        """Indices and values of the k largest scores per row, best first."""
+        n = scores.shape[1]
+        k = min(k, n)
+        if k < n:
+            part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            part = np.tile(np.arange(n), (scores.shape[0], 1))
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-part_scores, axis=1)
+        return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+    def _coarse_scores(self, vectors):
+        """Approximate scores from the quantised codes (higher is better)."""
+        n = len(self)
+        scores = np.empty((len(vectors), n), dtype=np.float32)
+        if self.quantization == "int8":
+            # Block-wise so only _BLOCK_ROWS rows are ever expanded to float32
+            for i in range(0, n, _BLOCK_ROWS):
+                scores[:, i:i+_BLOCK_ROWS] = vectors @ self.codes[i:i+_BLOCK_ROWS].astype(np.float32).T
+        else:
+            # Negative Hamming distance between sign bits
+            q_bits = np.packbits(vectors > 0, axis=1)
+            for i in range(0, n, _BLOCK_ROWS):
+                xor = np.asarray(self.codes[i:i+_BLOCK_ROWS])[None, :, :] ^ q_bits[:, None, :]
+                bits = np.bitwise_count(xor) if hasattr(np, "bitwise_count") else _POPCOUNT[xor]
+                scores[:, i:i+_BLOCK_ROWS] = -bits.sum(axis=2, dtype=np.int32)
+        return scores
+
+    def top_k(self, vectors, top_k=5, exact=False):
+        """(rows, scores) arrays of shape (n_queries, k), best first."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        if exact or self.codes is None:
+            return self._select(vectors @ self.vectors.T, top_k)
+
+        candidates, _ = self._select(self._coarse_scores(vectors), max(top_k * RESCORE_FACTOR, top_k))
+        k = min(top_k, candidates.shape[1])
+        rows = np.empty((len(vectors), k), dtype=np.int64)
+        scores = np.empty((len(vectors), k), dtype=np.float32)
+        for j, (q, cand) in enumerate(zip(vectors, candidates)):
+            cand = np.sort(cand)                       # sequential reads from the mmap
+            exact_scores = self.vectors[cand] @ q
+            order = np.argsort(-exact_scores)[:k]
+            rows[j], scores[j] = cand[order], exact_scores[order]
+        return rows, scores
+
+    def memory_bytes(self):
+        """Bytes scanned per query: the codes if quantised, else the float matrix."""
+        return (self.codes if self.codes is not None else self.vectors).nbytes
+
+    def search(self, vectors, top_k=5, with_vectors=False):
+        if len(self) == 0:
+            return [[] for _ in range(len(vectors))]
+        rows, scores = self.top_k(vectors, top_k)
+        results = []
+        for q_rows, q_scores in zip(rows, scores):
+            hits = []
+            for row, score in zip(q_rows, q_scores):
+                d = self.doc(row)
+                hit = {
+                    "score": float(score),
+                    "id": d["id"],
+                    "title": d.get("title"),
+                    "url": d.get("url"),
+                    "content": d.get("content"),
+                    "aliases": d.get("aliases", [])
+                }
+                if with_vectors:
+                    hit["embedding"] = np.array(self.vectors[row])
+                hits.append(hit)
+            results.append(hits)
+        return results
+
+
+class NumpyStoreWriter:
+    """
+    Streams (ids, vectors, docs) into a new NumpyStore. The store is built in
+    a side directory and swapped in on close(), so readers never see a
+    half-written index; processes still mapping the old files keep working.
+    """
+
+    def __init__(self, dim, model_name, path=NUMPY_STORE_DIR, quantization="none"):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization!r} (expected one of {QUANTIZATIONS})")
+        self.dim = dim
+        self.model_name = model_name
+        self.quantization = quantization
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.name + ".tmp")
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        self.tmp.mkdir(parents=True)
+        self._raw = open(self.tmp / "embeddings.f32", "wb")
+        self._docs = open(self.tmp / "docs.jsonl", "wb")
+        self.offsets = [0]
+        self.count = 0
+
+    def add(self, ids, vectors, contents, urls, titles, aliases=None):
+        self._raw.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        for i, (_id, content, url, title) in enumerate(zip(ids, contents, urls, titles)):
+            doc = {"id": _id, "url": url, "title": title, "content": content}
+            if aliases and aliases[i]:
+                doc["aliases"] = aliases[i]
+            line = (json.dumps(doc, ensure_ascii=False) + "\n").encode("utf-8")
+            self._docs.write(line)
+            self.offsets.append(self.offsets[-1] + len(line))
+        self.count += len(ids)
+
+    def close(self):
+        self._raw.close()
+        self._docs.close()
+
+        # Raw rows -> .npy now that the final shape is known, copied in slices
+        raw_path = self.tmp / "embeddings.f32"
+        out = np.lib.format.open_memmap(self.tmp / "embeddings.npy", mode="w+",
+                                        dtype=np.float32, shape=(self.count, self.dim))
+        max_abs = 0.0
+        if self.count:
+            raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+            for i in range(0, self.count, _BLOCK_ROWS):
+                out[i:i+_BLOCK_ROWS] = raw[i:i+_BLOCK_ROWS]
+                max_abs = max(max_abs, float(np.abs(raw[i:i+_BLOCK_ROWS]).max()))
+            del raw
+        out.flush()
+        os.remove(raw_path)
+
+        manifest = {"count": self.count, "dim": self.dim, "model": self.model_name,
+                    "quantization": self.quantization}
+        if self.quantization == "int8":
+            # One symmetric scale for the whole matrix; rankings only need relative values
+            scale = 127.0 / max_abs if max_abs else 1.0
+            codes = np.lib.format.open_memmap(self.tmp / "embeddings.int8.npy", mode="w+",
+                                              dtype=np.int8, shape=(self.count, self.dim))
+            for i in range(0, self.count, _BLOCK_ROWS):
+                codes[i:i+_BLOCK_ROWS] = np.clip(np.rint(out[i:i+_BLOCK_ROWS] * scale), -127, 127)
+            codes.flush()
+            del codes
+            manifest["int8_scale"] = scale
+        elif self.quantization == "binary":
+            codes = np.lib.format.open_memmap(self.tmp / "embeddings.bin.npy", mode="w+",
+                                              dtype=np.uint8, shape=(self.count, (self.dim + 7) // 8))
+            for i in range(0, self.count, _BLOCK_ROWS):
+                codes[i:i+_BLOCK_ROWS] = np.packbits(out[i:i+_BLOCK_ROWS] > 0, axis=1)
+            codes.flush()
+            del codes
+        del out
+
+        np.save(self.tmp / "offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        with open(self.tmp / "manifest.json", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+        old = self.path.with_name(self.path.name + ".old")
+        shutil.rmtree(old, ignore_errors=True)
+        if self.path.exists():
+            os.replace(self.path, old)
+        os.replace(self.tmp, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        print(f"NumPy vector store written: {self.count} vectors ({self.quantization}) -> {self.path}")
+
+
+def open_store(backend=VECTOR_BACKEND, model=None):
+    """
+    Open the configured backend; None if its index has not been built.
+    `model` is the encoder key queries are embedded with; a NumPy store
+    built with another one raises ValueError.
+    """
+    if backend == "numpy":
+        return NumpyStore.open(model=model)
+    if backend == "milvus":
+        return MilvusStore.open()
+    raise ValueError(f"Unknown vector backend: {backend!r} (expected 'milvus' or 'numpy')")
+
+
+def _percentile_ms(samples, p):
+    return float(np.percentile(samples, p) * 1000.0)
+
+
+if __name__ == "__main__":
+    # Latency comparison of both backends, with real queries (--queries-file,
+    # encoded like the retriever does) or, failing that, stored vectors.
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare NumPy and Milvus search latency")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--queries-file", help="Text file with one query per line (e.g. from the API logs)")
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    np_store = NumpyStore.open()
+    if np_store is None or len(np_store) == 0:
+        raise SystemExit("Build the NumPy store first: python backend/rag/indexer.py --backend numpy")
+    query_rows = None       # store row each query was taken from, if any
+    if args.queries_file:
+        try:
+            from encoder import get_encoder, EMBED_MODEL, ENCODER_BACKEND
+        except ImportError:
+            from .encoder import get_encoder, EMBED_MODEL, ENCODER_BACKEND
+        with open(args.queries_file, "r", encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()][:args.queries]
+        queries = np.asarray(get_encoder(EMBED_MODEL, backend=ENCODER_BACKEND).encode(texts), dtype=np.float32)
+    else:
+        rng = np.random.default_rng(0)
+        query_rows = rng.choice(len(np_store), min(args.queries, len(np_store)), replace=False)
+        queries = np.asarray(np_store.vectors[query_rows])
+    print(f"{len(np_store)} vectors, {len(queries)} queries"
+          f"{'' if args.queries_file else ' (stored vectors)'}, top_k={args.top_k}")
+
+    results = {}
+    for name, store in (("numpy", np_store), ("milvus", MilvusStore.open())):
+        if store is None:
+            print(f"{name}: not built, skipped")
+            continue
+        store.search(queries[:1], args.top_k)   # warm
+        samples, ids = [], []
+        for q in queries:
+            start = time.perf_counter()
+            hits = store.search(q[None, :], args.top_k)[0]
+            samples.append(time.perf_counter() - start)
+            ids.append([h["id"] for h in hits])
+        results[name] = ids
+        print(f"{name:>7}: p50 {_percentile_ms(samples, 50):.2f} ms  p95 {_percentile_ms(samples, 95):.2f} ms  "
+              f"mean {np.mean(samples) * 1000:.2f} ms")
+
+    if len(results) == 2:
+        overlap = np.mean([len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(results["numpy"], results["milvus"])])
+        print(f"top-{args.top_k} agreement numpy vs milvus: {overlap:.3f}")
+
+    if np_store.codes is not None:
+        # Recall of the quantised search against the exact float search. A
+        # stored vector always finds its own row first (distance 0), which
+        # would inflate recall, so that row is left out of both result lists.
+        k = args.top_k + (query_rows is not None)
+        exact_rows, _ = np_store.top_k(queries, k, exact=True)
+        approx_rows, _ = np_store.top_k(queries, k)
+        exact_sets, approx_sets = [], []
+        for j, (a, b) in enumerate(zip(exact_rows, approx_rows)):
+            if query_rows is not None:
+                a, b = a[a != query_rows[j]], b[b != query_rows[j]]
+            exact_sets.append(set(a[:args.top_k]))
+            approx_sets.append(set(b[:args.top_k]))
+        recall = np.mean([len(a & b) / max(len(a), 1) for a, b in zip(exact_sets, approx_sets)])
+        print(f"{np_store.quantization} recall@{args.top_k} vs float: {recall:.3f} "
+              f"(rescore factor {RESCORE_FACTOR})")
+        print(f"vector memory scanned per query: {np_store.memory_bytes() / 1e6:.1f} MB "
+              f"vs {np_store.vectors.nbytes / 1e6:.1f} MB float32")